@@ -0,0 +1,278 @@
+import asyncio
+import itertools
+import json
+import os
+import random
+import re
+from concurrent.futures import ProcessPoolExecutor
+
+import grpc
+import pandas as pd
+import pydgraph
+from metrics import metrics
+from rdf_lib import df_to_rdf_map, rdf_map_to_rdf
+from upload_csv import (
+    AdaptiveBatcher,
+    abortBackoff,
+    abortTries,
+    chunkSize,
+    getEndpoints,
+    pendingSlices,
+    re_blank_bracket,
+    re_blank_node,
+    substituteXid,
+    upsertSize,
+)
+
+# asyncio loader: the stages are connected by bounded queues
+#   CSV chunk read -> template render (executor) -> xid resolution -> uid allocation -> mutations
+# and the gRPC calls go through grpc.aio (pydgraph async client), so many mutations
+# are in flight without threads. The xidmap is only used by the event loop thread.
+
+concurrency = 64  # mutations in flight
+
+
+def getAsyncClientStub(dgraph_grpc):
+    # same endpoints as getClientStub, on a grpc.aio channel
+    if "cloud.dgraph.io" in dgraph_grpc:
+        assert "DGRAPH_ADMIN_KEY" in os.environ, "DGRAPH_ADMIN_KEY must be set"
+        APIAdminKey = os.environ["DGRAPH_ADMIN_KEY"]
+        client_stub = pydgraph.AsyncDgraphClientStub.from_cloud(dgraph_grpc, APIAdminKey)
+        print("async cloud client " + dgraph_grpc)
+    elif "hypermode.host" in dgraph_grpc:
+        assert "HYPERMODE_DGRAPH_TOKEN" in os.environ, "HYPERMODE_DGRAPH_TOKEN must be set"
+        TOKEN = os.environ["HYPERMODE_DGRAPH_TOKEN"]
+        creds = grpc.ssl_channel_credentials()
+        call_credentials = grpc.access_token_call_credentials(TOKEN)
+        composite_credentials = grpc.composite_channel_credentials(creds, call_credentials)
+        client_stub = pydgraph.AsyncDgraphClientStub(dgraph_grpc, credentials=composite_credentials)
+        print("async hypermode client " + dgraph_grpc)
+    else:
+        client_stub = pydgraph.AsyncDgraphClientStub(dgraph_grpc)
+        print("async local client " + dgraph_grpc)
+    return client_stub
+
+
+class AsyncClientPool:
+    # async counterpart of ClientPool: channels over the endpoints of DGRAPH_GRPC used round-robin.
+    # Must be created in the event loop.
+    def __init__(self, size=None):
+        endpoints = getEndpoints()
+        if size is None:
+            size = len(endpoints)
+        self.stubs = [getAsyncClientStub(endpoints[i % len(endpoints)]) for i in range(size)]
+        self.clients = [pydgraph.AsyncDgraphClient(stub) for stub in self.stubs]
+        self.counter = itertools.count()
+
+    def txn(self, *args, **kwargs):
+        return self.clients[next(self.counter) % len(self.clients)].txn(*args, **kwargs)
+
+    async def close(self):
+        for stub in self.stubs:
+            await stub.close()
+        self.stubs = []
+        self.clients = []
+
+
+def render_slices(chunk, template):
+    # executed in the executor: transform the dataframe, return the RDF slices of rdf_map_to_rdf
+    slices = []
+    rdf_map_to_rdf(df_to_rdf_map(chunk, template, True), slices.append)
+    return slices
+
+
+async def upsert_xids_async(client, blank):
+    # async upsert_xids: return the xid -> uid map of the blank nodes
+    query_list = ["{"]
+    nquad_list = []
+    blank_map = {}
+    for idx, n in enumerate(blank):
+        blank_map[f"u_{idx}"] = n
+        query_list.append(f'u_{idx} as u_{idx}(func: eq(xid, "{n}")) {{uid}}')
+        nquad_list.append(f'uid(u_{idx}) <xid> "{n}" .')
+    query_list.append("}")
+    txn = client.txn()
+    try:
+        mutation = txn.create_mutation(set_nquads="\n".join(nquad_list))
+        request = txn.create_request(query="\n".join(query_list), mutations=[mutation])
+        res = await txn.do_request(request)
+        await txn.commit()
+        metrics.count("upserts")
+        metrics.count("xids_allocated", len(res.uids))
+        #  new uid for xid are in res.uids
+        #  existing uid for xid are res.json payload
+        allocated = {}
+        for n in res.uids:
+            idx = n[n.index("(") + 1 : n.index(")")]
+            allocated["<" + blank_map[idx] + ">"] = "<" + res.uids[n] + ">"
+        queries = json.loads(res.json)
+        for idx in queries:
+            if len(queries[idx]) > 0:
+                allocated["<" + blank_map[idx] + ">"] = "<" + queries[idx][0]["uid"] + ">"
+        return allocated
+    finally:
+        await txn.discard()
+
+
+async def mutate_rdf_async(client, nquads):
+    # async mutate_rdf, aborted mutations are retried after a jittered backoff
+    ret = {}
+    if len(nquads) > 0:
+        body = "\n".join(nquads)
+        tries = abortTries
+        for i in range(tries):
+            txn = client.txn()
+            try:
+                with metrics.timer("mutate"):
+                    res = await txn.mutate(set_nquads=body)
+                with metrics.timer("commit"):
+                    await txn.commit()
+                ret["nquads"] = (len(nquads),)
+                ret["total_ns"] = res.latency.total_ns
+                metrics.count("mutations")
+                metrics.count("triples", len(nquads))
+            except pydgraph.errors.AbortedError:
+                print("AbortedError %s" % i)
+                ret["aborts"] = i + 1
+                metrics.count("aborts")
+                if i < tries - 1:
+                    await asyncio.sleep(random.uniform(0, abortBackoff * 2**i))
+                continue
+            except Exception as inst:
+                print(type(inst))  # the exception type
+                print(inst)
+                break
+            finally:
+                await txn.discard()
+            break
+    return ret
+
+
+class AsyncLoader:
+    # load CSV files to Dgraph with the asyncio pipeline.
+    # Mutations are partitioned by subject over `concurrency` queues, each sent by one task,
+    # so the triples of a subject are never in two concurrent transactions.
+    def __init__(self, client, xidmap, concurrency=concurrency, batcher=None, chunksize=chunkSize, executor=None):
+        self.client = client
+        self.xidmap = xidmap
+        self.batcher = batcher if batcher is not None else AdaptiveBatcher()
+        self.chunksize = chunksize
+        self.executor = executor
+        self.failed = 0
+        self.chunks = asyncio.Queue(maxsize=2)
+        self.slices = asyncio.Queue(maxsize=pendingSlices)
+        self.resolved = asyncio.Queue(maxsize=pendingSlices)
+        self.mutations = [asyncio.Queue(maxsize=pendingSlices) for _ in range(concurrency)]
+
+    async def read(self, csv_files):
+        loop = asyncio.get_running_loop()
+        for f, template in csv_files:
+            print(f)
+            reader = pd.read_csv(f, keep_default_na=True, dtype=str, chunksize=self.chunksize)
+            while True:
+                with metrics.timer("read"):
+                    chunk = await loop.run_in_executor(None, next, reader, None)
+                if chunk is None:
+                    break
+                metrics.count("rows", len(chunk))
+                await self.chunks.put((chunk, template))
+        await self.chunks.put(None)
+
+    async def render(self):
+        loop = asyncio.get_running_loop()
+        while (item := await self.chunks.get()) is not None:
+            chunk, template = item
+            with metrics.timer("render"):
+                slices = await loop.run_in_executor(self.executor, render_slices, chunk, template)
+            for body in slices:
+                await self.slices.put(body)
+        await self.slices.put(None)
+
+    async def resolve(self):
+        # substitute the known xids and list the blank nodes left
+        while (body := await self.slices.get()) is not None:
+            with metrics.timer("xid"):
+                body = re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, self.xidmap), body)
+            await self.resolved.put((body, set(re.findall(re_blank_node, body))))
+        await self.resolved.put(None)
+
+    async def allocate(self):
+        # slices are handled in order: the xids allocated for a slice are known by the next ones.
+        # The upserts of a slice are sent concurrently.
+        while (item := await self.resolved.get()) is not None:
+            body, blank = item
+            missing = [n for n in blank if "<" + n + ">" not in self.xidmap]
+            groups = [missing[start : start + upsertSize] for start in range(0, len(missing), upsertSize)]
+            with metrics.timer("allocate"):
+                for allocated in await asyncio.gather(*[upsert_xids_async(self.client, g) for g in groups]):
+                    self.xidmap.update(allocated)
+            if len(blank) > 0:
+                with metrics.timer("xid"):
+                    body = re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, self.xidmap), body)
+            # no more blank node at this point
+            parts = [[] for _ in self.mutations]
+            for line in body.split("\n"):
+                if line != "":
+                    parts[hash(line[: line.find(" ")]) % len(parts)].append(line)
+            for mutations, part in zip(self.mutations, parts):
+                if len(part) > 0:
+                    await mutations.put(part)
+        for mutations in self.mutations:
+            await mutations.put(None)
+
+    async def mutate(self, mutations):
+        stop = False
+        while not stop:
+            lines = await mutations.get()
+            if lines is None:
+                break
+            nbytes = sum(len(line) + 1 for line in lines)
+            # merge the parts already queued up to the batch size
+            while nbytes < self.batcher.size and not mutations.empty():
+                part = mutations.get_nowait()
+                if part is None:
+                    stop = True
+                    break
+                lines.extend(part)
+                nbytes += sum(len(line) + 1 for line in part)
+            for batch, size in self.batcher.batches(lines):
+                start = asyncio.get_running_loop().time()
+                all_res = await mutate_rdf_async(self.client, batch)
+                self.batcher.record(size, all_res, int((asyncio.get_running_loop().time() - start) * 1e9))
+                if "nquads" not in all_res:
+                    self.failed += 1
+                    metrics.count("failed")
+
+    async def run(self, csv_files):
+        tasks = [
+            asyncio.create_task(self.read(csv_files)),
+            asyncio.create_task(self.render()),
+            asyncio.create_task(self.resolve()),
+            asyncio.create_task(self.allocate()),
+        ] + [asyncio.create_task(self.mutate(mutations)) for mutations in self.mutations]
+        try:
+            done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            for task in done:
+                if task.exception() is not None:
+                    raise task.exception()
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return self.xidmap
+
+
+async def load_async(csv_files, xidmap, channels=None, concurrency=concurrency, batcher=None, chunksize=chunkSize, render_workers=1):
+    # csv_files: list of (csv file, template)
+    client = AsyncClientPool(channels)
+    executor = ProcessPoolExecutor(max_workers=render_workers) if render_workers > 1 else None
+    try:
+        loader = AsyncLoader(client, xidmap, concurrency, batcher, chunksize, executor)
+        await loader.run(csv_files)
+        if loader.failed > 0:
+            print(f"{loader.failed} mutations failed")
+    finally:
+        if executor is not None:
+            executor.shutdown()
+        await client.close()
+    return xidmap
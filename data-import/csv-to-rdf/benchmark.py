@@ -0,0 +1,245 @@
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import legacy_rdf_lib
+from rdf_lib import df_to_rdffile
+
+# Benchmark of the template rendering (rdf_lib) on synthetic CSV files.
+# Each scenario is a generated CSV and its template, each engine renders it to RDF in a fresh process:
+#   rows/s, triples/s and peak RSS are reported per scenario and engine,
+#   --save stores the results as a baseline, --baseline compares a run to it.
+#
+#   python benchmark.py --save baseline.json
+#   python benchmark.py --baseline baseline.json --tolerance 0.2
+
+defaultRows = 20000
+defaultRepeat = 3
+defaultTolerance = 0.2  # slower by more than 20% is a regression
+
+# scenario: parameters of make_csv
+SCENARIOS = {
+    "basic": dict(columns=4, nan_ratio=0.0, lists=0, geo=0),
+    "wide": dict(columns=40, nan_ratio=0.0, lists=0, geo=0),
+    "sparse": dict(columns=10, nan_ratio=0.5, lists=0, geo=0),
+    "lists": dict(columns=2, nan_ratio=0.1, lists=3, geo=0),
+    "geo": dict(columns=2, nan_ratio=0.0, lists=0, geo=3),
+    "mixed": dict(columns=10, nan_ratio=0.2, lists=2, geo=2),
+}
+
+
+# engine: function(df, template, filehandle) writing the RDF of df to filehandle
+ENGINES = {
+    # reference engine: the row by row substituteInTemplate of the baseline, pinned in legacy_rdf_lib.py
+    "legacy": lambda df, template, out: legacy_rdf_lib.df_to_rdffile(df, template, out),
+    "rows": lambda df, template, out: df_to_rdffile(df, template, out, vectorized=False),
+    "vectorized": lambda df, template, out: df_to_rdffile(df, template, out, vectorized=True),
+    "stream": lambda df, template, out: df_to_rdffile(df, template, out, vectorized=True, stream=True),
+}
+defaultEngines = ["rows", "vectorized", "stream"]
+
+
+def make_csv(path, rows, columns, nan_ratio, lists, geo, seed=0):
+    # write a CSV of rows lines and return its template. The columns are:
+    #   ID unique, GROUP and KIND low cardinality with spaces and punctuation (nodes shared by many rows),
+    #   T0..Tn text, DATE, L0..Ln list values "['a','b']" for split, LAT0/LNG0.. for geoloc.
+    # nan_ratio of the T, L and DATE values are empty
+    rng = np.random.default_rng(seed)
+    words = np.array(["alpha", "beta", "gamma", "delta", "epsilon", "zeta", "eta", "theta", 'quote"d', "l'apostrophe"])
+    groups = np.array([f"Group {i}/{chr(65 + i % 26)}" for i in range(max(rows // 100, 1))])
+    kinds = np.array(["Small", "Medium", "Large"])
+
+    def with_nan(values):
+        values = values.astype(object)
+        values[rng.random(rows) < nan_ratio] = None
+        return values
+
+    data = {
+        "ID": [f"id-{i:08d}" for i in range(rows)],
+        "GROUP": groups[rng.integers(0, len(groups), rows)],
+        "KIND": kinds[rng.integers(0, len(kinds), rows)],
+    }
+    for c in range(columns):
+        data[f"T{c}"] = with_nan(
+            np.char.add(np.char.add(words[rng.integers(0, len(words), rows)], " "), rng.integers(0, 1000, rows).astype(str))
+        )
+    seconds = rng.integers(0, 3 * 365 * 86400, rows).astype("timedelta64[s]")
+    dates = pd.Series(np.datetime64("2020-01-01T00:00:00") + seconds).dt.strftime("%Y-%m-%d %H:%M:%S").to_numpy()
+    data["DATE"] = with_nan(dates)
+    for c in range(lists):
+        sizes = rng.integers(1, 6, rows)
+        data[f"L{c}"] = with_nan(
+            np.array(["[" + ",".join(f"'{w}'" for w in words[rng.integers(0, 8, n)]) + "]" for n in sizes])
+        )
+    for c in range(geo):
+        data[f"LAT{c}"] = np.round(rng.uniform(-90, 90, rows), 6)
+        data[f"LNG{c}"] = np.round(rng.uniform(-180, 180, rows), 6)
+    pd.DataFrame(data).to_csv(path, index=False)
+
+    # every function and the uid transforms of the template syntax
+    template = [
+        '<_:Item_[ID]> <dgraph.type> "Item" .',
+        '<_:Item_[ID]> <xid> "_:Item_[ID]" .',
+        '<_:Item_[ID]> <Item.line> "[LINENUMBER]" .',
+        '<_:Group_[GROUP]> <dgraph.type> "Group" .',
+        '<_:Group_[GROUP]> <Group.name> "[GROUP,toUpper]" .',
+        '<_:Group_[GROUP]_[KIND]> <Group.kind> "[KIND,toLower]" .',
+        '<_:Item_[ID]> <Item.label> "[GROUP,nospace] [KIND]" .',
+        "<_:Item_[ID]> <Item.group> <_:Group_[GROUP]_[KIND]> .",
+        "<_:Group_[GROUP]_[KIND]> <Group.items> <_:Item_[ID]> *",
+        "<_:Item_[ID]> <Item.created> =datetime([DATE],%Y-%m-%d %H:%M:%S) .",
+        "<_:Item_[ID]> <Item.day> =randomDate(2020-01-01,2022-12-31) .",
+    ]
+    template += [f'<_:Item_[ID]> <Item.t{c}> "[T{c}]" .' for c in range(columns)]
+    template += [f"<_:Item_[ID]> <Item.tags{c}> =split([L{c}]) *" for c in range(lists)]
+    template += [f"<_:Item_[ID]> <Item.geoloc{c}> =geoloc([LAT{c}],[LNG{c}]) ." for c in range(geo)]
+    return "\n".join(template) + "\n"
+
+
+class CountingFile:
+    # file handle counting the RDF lines written
+    def __init__(self):
+        self.lines = 0
+        self.bytes = 0
+
+    def write(self, body):
+        self.lines += body.count("\n")
+        self.bytes += len(body)
+
+
+def peak_rss_mb():
+    # ru_maxrss is in KB on Linux, in bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+
+def run_engine(engine, csv_file, template, repeat, results):
+    # executed in a fresh process so the peak RSS is the one of this engine
+    df = pd.read_csv(csv_file, keep_default_na=True, dtype=str)
+    base_rss = peak_rss_mb()
+    best = None
+    for _ in range(repeat):
+        random.seed(0)
+        out = CountingFile()
+        start = time.perf_counter()
+        ENGINES[engine](df.copy(), template, out)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    results.put(
+        {
+            "rows": len(df),
+            "triples": out.lines,
+            "seconds": round(best, 4),
+            "rows_per_s": round(len(df) / best, 1),
+            "triples_per_s": round(out.lines / best, 1),
+            "peak_rss_mb": round(peak_rss_mb(), 1),
+            "render_rss_mb": round(peak_rss_mb() - base_rss, 1),
+        }
+    )
+
+
+def measure(engine, csv_file, template, repeat):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_engine, args=(engine, csv_file, template, repeat, results))
+    process.start()
+    # the result is a small dict, the process can exit before it is read
+    process.join()
+    if process.exitcode != 0:
+        raise RuntimeError(f"engine {engine} failed on {os.path.basename(csv_file)}")
+    return results.get()
+
+
+def compare(results, baseline, tolerance):
+    # list the regressions: throughput lower or peak RSS higher than the baseline by more than tolerance
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        base = baseline[key]
+        if result["rows_per_s"] < base["rows_per_s"] * (1 - tolerance):
+            regressions.append(f"{key}: {result['rows_per_s']:.0f} rows/s, baseline {base['rows_per_s']:.0f}")
+        if result["render_rss_mb"] > max(base["render_rss_mb"], 1) * (1 + tolerance):
+            regressions.append(f"{key}: render {result['render_rss_mb']} MB, baseline {base['render_rss_mb']} MB")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the rdf_lib template rendering engines")
+    parser.add_argument("--rows", type=int, default=defaultRows, help=f"rows per scenario (default {defaultRows})")
+    parser.add_argument(
+        "--scenarios", default=",".join(SCENARIOS), help="comma-separated scenarios (default all: %(default)s)"
+    )
+    parser.add_argument(
+        "--engines",
+        default=",".join(defaultEngines),
+        help=f"comma-separated engines among {', '.join(ENGINES)} (default %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=defaultRepeat, help=f"runs per engine, the best is kept (default {defaultRepeat})"
+    )
+    parser.add_argument("--baseline", default=None, help="JSON results of a previous run to compare to")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=defaultTolerance,
+        help=f"relative slowdown reported as a regression (default {defaultTolerance})",
+    )
+    parser.add_argument("--save", default=None, help="JSON file to write the results to, e.g. a new baseline")
+    args = parser.parse_args()
+
+    scenarios = args.scenarios.split(",")
+    engines = args.engines.split(",")
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error(f"unknown scenario {name}")
+    for engine in engines:
+        if engine not in ENGINES:
+            parser.error(f"unknown engine {engine}")
+
+    baseline = None
+    if args.baseline is not None:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)["results"]
+
+    results = {}
+    print(f"{'scenario/engine':<24}{'rows/s':>12}{'triples/s':>12}{'triples':>10}{'peak MB':>9}{'render MB':>11}{'vs base':>9}")
+    with tempfile.TemporaryDirectory() as tmp:
+        for name in scenarios:
+            csv_file = os.path.join(tmp, name + ".csv")
+            template = make_csv(csv_file, args.rows, **SCENARIOS[name])
+            for engine in engines:
+                key = name + "/" + engine
+                result = measure(engine, csv_file, template, args.repeat)
+                results[key] = result
+                ratio = ""
+                if baseline is not None and key in baseline:
+                    ratio = f"{result['rows_per_s'] / baseline[key]['rows_per_s']:.2f}x"
+                print(
+                    f"{key:<24}{result['rows_per_s']:>12.0f}{result['triples_per_s']:>12.0f}{result['triples']:>10}"
+                    f"{result['peak_rss_mb']:>9.1f}{result['render_rss_mb']:>11.1f}{ratio:>9}",
+                    flush=True,
+                )
+
+    if args.save is not None:
+        with open(args.save, "w") as save_file:
+            json.dump({"rows": args.rows, "python": sys.version.split()[0], "results": results}, save_file, indent=2)
+
+    if baseline is not None:
+        regressions = compare(results, baseline, args.tolerance)
+        for regression in regressions:
+            print("regression " + regression)
+        if len(regressions) > 0:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,46 +1,272 @@
+import argparse
+import io
+import itertools
 import os
 import sys
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
 
 import pandas as pd
-from rdf_lib import df_to_rdffile
+from rdf_lib import DedupWriter, RdfFileWriter, RecentKeys, UidWriter, df_to_rdffile, list_predicates
+from metrics import ProgressReporter, metrics
+from xidmap import CompactXidMap, SqliteXidMap
 
-if len(sys.argv) < 2:
-    print("Usage: csv_to_rdf.py <directory> <output_file>")
-    print(
-        "<directory> is the directory containing the CSV files and their associated templates"
+CHUNK_SIZE = 100000
+DEDUP_WINDOW = 100000
+
+
+def templates(csvdir):
+    # templates of the CSV files of the directory
+    for filename in os.listdir(csvdir):
+        base = os.path.join(csvdir, os.path.splitext(filename)[0])
+        if filename.endswith(".csv") and os.path.isfile(base + ".template"):
+            with open(base + ".template", "r") as template_file:
+                yield template_file.read()
+
+
+def csv_chunks(csvdir, chunksize=CHUNK_SIZE):
+    # iterate over files in
+    # that directory
+    # get CSV file and associated template file
+    # yield the chunks of the CSV with their template
+    for filename in os.listdir(csvdir):
+        f = os.path.join(csvdir, filename)
+        if os.path.isfile(f) and filename.endswith(".csv"):
+            base = os.path.splitext(f)[0]
+            templatefilename = base + ".template"
+            if os.path.isfile(templatefilename):
+                template_file = open(templatefilename, "r")
+                template = template_file.read()
+                template_file.close()
+                reader = pd.read_csv(f, keep_default_na=True, chunksize=chunksize, dtype=str)
+                while True:
+                    with metrics.timer("read"):
+                        chunk = next(reader, None)
+                    if chunk is None:
+                        break
+                    metrics.count("rows", len(chunk))
+                    yield chunk, template
+
+
+def chunk_to_file(chunk, template, rdf_file_handle, stream=False, dedup_window=DEDUP_WINDOW):
+    # transform the dataframe and write to file
+    # in stream mode, RDF are written as they are rendered and
+    # duplicates are removed among the last dedup_window triples
+    dedup = RecentKeys(dedup_window) if stream else None
+    df_to_rdffile(chunk, template, rdf_file_handle, vectorized=True, stream=stream, dedup=dedup)
+
+
+def chunk_to_rdf(chunk, template, stream=False, dedup_window=DEDUP_WINDOW):
+    # may be executed in a worker process: transform the dataframe and return the RDF text
+    # and the time spent
+    start = time.perf_counter()
+    buffer = io.StringIO()
+    chunk_to_file(chunk, template, buffer, stream, dedup_window)
+    return buffer.getvalue(), time.perf_counter() - start
+
+
+def write_rdf(rdf_file_handle, result):
+    # write the result of chunk_to_rdf and record the render time
+    text, seconds = result
+    metrics.record("render", seconds)
+    metrics.count("triples", text.count("\n"))
+    with metrics.timer("write"):
+        rdf_file_handle.write(text)
+
+
+def convert(csvdir, rdf_file_handle, chunksize=CHUNK_SIZE, stream=False, dedup_window=DEDUP_WINDOW):
+    for chunk, template in csv_chunks(csvdir, chunksize):
+        write_rdf(rdf_file_handle, chunk_to_rdf(chunk, template, stream, dedup_window))
+
+
+def convert_parallel(csvdir, rdf_file_handle, workers, ordered=True, max_pending=None, chunksize=CHUNK_SIZE, stream=False, dedup_window=DEDUP_WINDOW):
+    # chunks are converted by a pool of processes
+    # at most max_pending chunks are read and not yet written, the reader waits for the writer
+    # if ordered is False, chunks are written as soon as they are converted
+    if max_pending is None:
+        max_pending = 2 * workers
+
+    def write_next(pending):
+        # write the oldest chunk, or the converted ones if the order does not matter
+        if ordered:
+            done = [pending.popleft()]
+        else:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                pending.remove(future)
+        for future in done:
+            write_rdf(rdf_file_handle, future.result())
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        for chunk, template in csv_chunks(csvdir, chunksize):
+            while len(pending) >= max_pending:
+                write_next(pending)
+            pending.append(pool.submit(chunk_to_rdf, chunk, template, stream, dedup_window))
+        while len(pending) > 0:
+            write_next(pending)
+
+
+def parse_size(size):
+    # "1000", "512K", "100M" or "2G" -> number of bytes
+    units = {"K": 1 << 10, "M": 1 << 20, "G": 1 << 30}
+    if size[-1].upper() in units:
+        return int(size[:-1]) * units[size[-1].upper()]
+    return int(size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert CSV files to RDF using their templates")
+    parser.add_argument(
+        "directory",
+        help="the directory containing the CSV files and their associated templates",
+    )
+    parser.add_argument(
+        "output_file",
+        nargs="?",
+        help="the file to write the RDF output to. If not provided, the output will be written to stdout",
     )
-    print(
-        "<output_file> is the file to write the RDF output to. If not provided, the output will be written to stdout"
+    parser.add_argument(
+        "--chunk-size", type=int, default=CHUNK_SIZE,
+        help=f"number of CSV lines converted at once (default {CHUNK_SIZE})",
     )
-    sys.exit(1)
+    parser.add_argument(
+        "--stream", action="store_true",
+        help="write RDF as rows are rendered instead of building a map of the chunk",
+    )
+    parser.add_argument(
+        "--dedup-window", type=int, default=DEDUP_WINDOW,
+        help=f"with --stream, number of recent triples used to remove duplicates (default {DEDUP_WINDOW})",
+    )
+    parser.add_argument(
+        "--dedup", action="store_true",
+        help="remove RDF already written by a previous chunk or CSV file (64-bit fingerprints, 16 bytes per subject and predicate)",
+    )
+    parser.add_argument(
+        "--compress", choices=["gzip", "zstd"], default=None,
+        help="compress the output file(s), the extension .gz or .zst is added",
+    )
+    parser.add_argument(
+        "--shard-lines", type=int, default=None,
+        help="split the output in files of at most this number of lines: <output>-000.rdf, <output>-001.rdf ...",
+    )
+    parser.add_argument(
+        "--shard-bytes", type=parse_size, default=None,
+        help="split the output in files of at most this size before compression, e.g. 512M or 2G",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of processes converting chunks in parallel (default 1)",
+    )
+    parser.add_argument(
+        "--unordered", action="store_true",
+        help="with --workers, write chunks as soon as they are converted instead of in the CSV order",
+    )
+    parser.add_argument(
+        "--max-pending", type=int, default=None,
+        help="with --workers, maximum number of chunks read and not yet written (default 2 x workers)",
+    )
+    parser.add_argument(
+        "--assign-uids", action="store_true",
+        help="replace the blank nodes by uids assigned in order (<0x1>, <0x2> ...), consistent across chunks and files, for dgraph bulk",
+    )
+    parser.add_argument(
+        "--first-uid", type=lambda x: int(x, 0), default=None,
+        help="with --assign-uids, first uid assigned, e.g. 0x10000 (default 1, or the next uid of --xidmap-out)",
+    )
+    parser.add_argument(
+        "--xidmap-out", default=None,
+        help="with --assign-uids, SQLite xid map file (upload_csv.py --xidmap-db) updated with the assigned uids; "
+        "the uids already in the file are reused",
+    )
+    parser.add_argument(
+        "--progress", type=float, default=10,
+        help="seconds between two progress lines on stderr, 0 to disable (default 10)",
+    )
+    parser.add_argument(
+        "--metrics", default=None,
+        help="JSON file to write the counters and the timings of each stage to",
+    )
+    args = parser.parse_args()
+    if (args.first_uid is not None or args.xidmap_out is not None) and not args.assign_uids:
+        parser.error("--first-uid and --xidmap-out require --assign-uids")
+    if args.assign_uids and args.unordered:
+        parser.error("--assign-uids requires the CSV order, it is not supported with --unordered")
 
-csvdir = sys.argv[1]
+    rdf_file_handle = sys.stdout
+    if args.output_file is not None:
+        # compression and writes are done by a thread while the next RDF are rendered
+        try:
+            rdf_file_handle = RdfFileWriter(
+                args.output_file, args.compress,
+                shard_lines=args.shard_lines, shard_bytes=args.shard_bytes,
+            )
+        except ImportError as e:
+            parser.error(str(e))
+    elif args.compress is not None or args.shard_lines is not None or args.shard_bytes is not None:
+        parser.error("--compress, --shard-lines and --shard-bytes require an output_file")
 
-rdf_file_handle = sys.stdout
-output_file = None
-if len(sys.argv) == 3:
-    output_file = sys.argv[2]
-    rdf_file_handle = open(output_file, "w")
+    rdf_output = rdf_file_handle
+    export = None
+    if args.assign_uids:
+        xidmap = CompactXidMap()
+        first_uid = 1
+        if args.xidmap_out is not None:
+            # continue the numbering of a previous export
+            export = SqliteXidMap(args.xidmap_out)
+            # streamed by batches of the CompactXidMap buffer, a dict of all the xids would cost ~150 bytes per xid
+            items = export.items()
+            while len(batch := dict(itertools.islice(items, xidmap.buffer_size))) > 0:
+                xidmap.update(batch)
+            # next_uid is missing in a map written by upload_csv and stale once upload_csv added the uids
+            # allocated by Dgraph: never number below the largest uid of the map, two xids would share a uid
+            max_uid = export.max_uid()
+            first_uid = max(int(export.get_meta("next_uid") or "1"), max_uid + 1)
+            if args.first_uid is not None and args.first_uid <= max_uid:
+                parser.error(
+                    f"--first-uid {hex(args.first_uid)} is not above the largest uid {hex(max_uid)} of {args.xidmap_out}"
+                )
+        if args.first_uid is not None:
+            first_uid = args.first_uid
+        rdf_output = UidWriter(rdf_output, xidmap, first_uid, export, metrics)
+    uid_writer = rdf_output
+    if args.dedup:
+        lists = set().union(*(list_predicates(template) for template in templates(args.directory)))
+        rdf_output = DedupWriter(rdf_output, metrics=metrics, list_predicates=lists)
 
+    progress = ProgressReporter(metrics, args.progress) if args.progress > 0 else None
 
-# iterate over files in
-# that directory
-# get CSV file and associated template file
-# load to dgraph and update the xidmap
-CHUNK_SIZE = 100000
-for filename in os.listdir(csvdir):
-    f = os.path.join(csvdir, filename)
-    if os.path.isfile(f) and filename.endswith(".csv"):
-        base = os.path.splitext(f)[0]
-        templatefilename = base + ".template"
-        if os.path.isfile(templatefilename):
-            template_file = open(templatefilename, "r")
-            template = template_file.read()
-            template_file.close()
-            # xidmap = df_to_dgraph(df,template,gclient,xidpredicate,xidmap)
-            for chunk in pd.read_csv(f, keep_default_na=True, chunksize=CHUNK_SIZE, dtype=str):
-                # transform the dataframe and write to file
-                print('.', end='', flush=True) # progress indicator
-                df_to_rdffile(chunk, template, rdf_file_handle)
-if rdf_file_handle is not sys.stdout:
-    rdf_file_handle.close()
+    if args.workers > 1:
+        convert_parallel(
+            args.directory, rdf_output, args.workers,
+            ordered=not args.unordered, max_pending=args.max_pending,
+            chunksize=args.chunk_size, stream=args.stream, dedup_window=args.dedup_window,
+        )
+    else:
+        convert(args.directory, rdf_output, args.chunk_size, args.stream, args.dedup_window)
+
+    if args.dedup:
+        print(f"\n{rdf_output.dropped} duplicated RDF removed, {rdf_output.written} written", file=sys.stderr)
+
+    if args.assign_uids:
+        print(f"\n{len(uid_writer.xidmap)} xids in the uid map, next uid {hex(uid_writer.next_uid)}", file=sys.stderr)
+        if export is not None:
+            export.set_meta("next_uid", str(uid_writer.next_uid))
+            export.set_meta("source", "csv_to_rdf")
+            export.close()
+
+    if rdf_file_handle is not sys.stdout:
+        with metrics.timer("write"):
+            files = rdf_file_handle.close()
+        if len(files) > 1:
+            print(f"\nRDF written to {files[0]} ... {files[-1]}", file=sys.stderr)
+
+    if progress is not None:
+        progress.close()
+    if args.metrics is not None:
+        metrics.write_summary(args.metrics)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,136 @@
+import json
+import sys
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+# upper bounds of the timing histogram buckets, in ms
+BUCKETS = [0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, float("inf")]
+
+
+class Histogram:
+    # timings of a stage: count, total, max and a log scale histogram for the percentiles
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0  # seconds
+        self.max = 0.0
+        self.buckets = [0] * len(BUCKETS)
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        ms = seconds * 1000
+        for i, bound in enumerate(BUCKETS):
+            if ms <= bound:
+                self.buckets[i] += 1
+                break
+
+    def percentile(self, p):
+        # upper bound of the bucket holding the p-th percentile, in ms
+        rank = p / 100 * self.count
+        seen = 0
+        for bound, n in zip(BUCKETS, self.buckets):
+            seen += n
+            if n > 0 and seen >= rank:
+                return min(bound, self.max * 1000)
+        return self.max * 1000
+
+    def summary(self):
+        return {
+            "count": self.count,
+            "total_s": round(self.total, 3),
+            "mean_ms": round(self.total * 1000 / self.count, 3) if self.count > 0 else 0,
+            "p50_ms": round(self.percentile(50), 3),
+            "p90_ms": round(self.percentile(90), 3),
+            "p99_ms": round(self.percentile(99), 3),
+            "max_ms": round(self.max * 1000, 3),
+            "buckets_ms": {str(bound): n for bound, n in zip(BUCKETS, self.buckets) if n > 0},
+        }
+
+
+class Metrics:
+    # counters and timing histograms per stage of the importers, shared by their threads:
+    #   with metrics.timer("render"): ...
+    #   metrics.count("rows", len(df))
+    # stages: read, render, dedup, xid, allocate, mutate, commit
+    # counters: rows, triples, upserts, xids_allocated, mutations, aborts, failed ...
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.counters = defaultdict(int)
+        self.timings = defaultdict(Histogram)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.counters[name] += n
+
+    def record(self, stage, seconds):
+        with self.lock:
+            self.timings[stage].add(seconds)
+
+    @contextmanager
+    def timer(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start)
+
+    def rates(self):
+        elapsed = max(time.time() - self.start, 1e-9)
+        return {
+            "rows_per_s": round(self.counters["rows"] / elapsed, 1),
+            "triples_per_s": round(self.counters["triples"] / elapsed, 1),
+        }
+
+    def progress_line(self):
+        with self.lock:
+            elapsed = time.time() - self.start
+            rates = self.rates()
+            stages = " ".join(f"{stage} {h.total:.1f}s" for stage, h in self.timings.items())
+            counters = " ".join(
+                f"{name} {n}" for name, n in self.counters.items() if name not in ("rows", "triples")
+            )
+        return (
+            f"[{elapsed:.0f}s] rows {self.counters['rows']} ({rates['rows_per_s']:.0f}/s) "
+            f"triples {self.counters['triples']} ({rates['triples_per_s']:.0f}/s) | {stages} | {counters}"
+        )
+
+    def summary(self):
+        with self.lock:
+            return {
+                "elapsed_s": round(time.time() - self.start, 3),
+                "counters": dict(self.counters),
+                **self.rates(),
+                "stages": {stage: h.summary() for stage, h in self.timings.items()},
+            }
+
+    def write_summary(self, path):
+        with open(path, "w") as summary_file:
+            json.dump(self.summary(), summary_file, indent=2)
+
+
+# metrics of the current import
+metrics = Metrics()
+
+
+class ProgressReporter:
+    # print the metrics progress line every interval seconds (stderr), and once more at close()
+    def __init__(self, metrics, interval=10, file=sys.stderr):
+        self.metrics = metrics
+        self.interval = interval
+        self.file = file
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            print(self.metrics.progress_line(), file=self.file, flush=True)
+
+    def close(self):
+        self.stopped.set()
+        self.thread.join()
+        print(self.metrics.progress_line(), file=self.file, flush=True)
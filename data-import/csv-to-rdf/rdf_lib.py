@@ -1,10 +1,21 @@
+import gzip
+import os
+import queue
 import random
 import re
 import sys
+import functools
 import json
+import threading
+import time
+from collections import OrderedDict
 from datetime import datetime, timedelta
 
+import numpy as np
+import pandas as pd
+
 sliceSize = 5000  # mutate every sliceSize RDF lines
+datetimeCacheSize = 65536  # datetime() conversions memoized
 
 re_blank_bracket = re.compile(r"(<_:\S+>)")
 re_blank_subject = re.compile(r"^\s*<(_:\S+)>")  # used for match subject
@@ -21,8 +32,13 @@ def substituteXid(match_obj, xidmap):
 
 
 def add_to_rdfBuffer(rdf, rdfBuffer, func, isList=False):
-    rdfBuffer.append(rdf)
-    if len(rdfBuffer) > sliceSize and isList is False:
+    # rdf is a RDF line, or with isList the list of RDF lines of a list predicate:
+    # the values of a list are flushed together, under the same sliceSize policy as single lines
+    if isList:
+        rdfBuffer.extend(rdf)
+    else:
+        rdfBuffer.append(rdf)
+    if len(rdfBuffer) > sliceSize:
         # substitute xidmap. xidmap is updated by the mutation
         # must be done in single thread as new xidmap is used for next data chunck
         func("\n".join(rdfBuffer) + "\n")
@@ -39,16 +55,15 @@ def rdf_map_to_rdf(rdf_map, func):
     rdfBuffer = []
     for k in rdf_map:
         if type(rdf_map[k]) is list:
-            for e in rdf_map[k]:
-                line = k + " " + e + " ."
-                add_to_rdfBuffer(line, rdfBuffer, func, True)
+            lines = [k + " " + e + " ." for e in rdf_map[k]]
+            add_to_rdfBuffer(lines, rdfBuffer, func, True)
         else:
             line = k + " " + rdf_map[k] + " ."
             add_to_rdfBuffer(line, rdfBuffer, func)
     flush_rdfBuffer(rdfBuffer, func)
 
 
-def rdf_map_to_file(rdf_map, xidmap, filehandle=sys.stdout):
+def rdf_writer(xidmap, filehandle):
     def f(body):
         return filehandle.write(
             re_blank_bracket.sub(
@@ -56,28 +71,368 @@ def rdf_map_to_file(rdf_map, xidmap, filehandle=sys.stdout):
             )
         )
 
-    rdf_map_to_rdf(rdf_map, f)
+    return f
+
+
+def rdf_map_to_file(rdf_map, xidmap, filehandle=sys.stdout):
+    rdf_map_to_rdf(rdf_map, rdf_writer(xidmap, filehandle))
     return xidmap
 
 
-def addRdfToMap(rdfMap,rdf):
+def rdf_stream_to_rdf(rdf_stream, func):
+    rdfBuffer = []
+    for line in rdf_stream:
+        add_to_rdfBuffer(line, rdfBuffer, func)
+    flush_rdfBuffer(rdfBuffer, func)
+
+
+def rdf_stream_to_file(rdf_stream, xidmap, filehandle=sys.stdout):
+    rdf_stream_to_rdf(rdf_stream, rdf_writer(xidmap, filehandle))
+    return xidmap
+
+
+class RecentKeys:
+    # last value written for the recent keys (LRU), used to drop duplicated RDF in streaming mode:
+    # the key is <subject> <predicate> for single value predicates, the whole triple for list predicates
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.keys = OrderedDict()
+
+    def seen(self, key, value):
+        # return True if value is the last value recorded for key, and record it
+        if key in self.keys:
+            self.keys.move_to_end(key)
+            if self.keys[key] == value:
+                return True
+        self.keys[key] = value
+        if len(self.keys) > self.capacity:
+            self.keys.popitem(last=False)
+        return False
+
+
+class FingerprintStore:
+    # last value written for every <subject> <predicate>, kept as 64-bit fingerprints
+    # in sorted NumPy runs (16 bytes per key), used to drop duplicated RDF across chunks and files.
+    # Runs are merged when they reach the size of the previous run, lookups search each run.
+    # Two keys with the same fingerprint would hide a triple, with 64 bits this is unlikely
+    # below billions of keys.
+    def __init__(self):
+        self.runs = []  # (sorted keys, values), oldest first
+
+    def __len__(self):
+        # number of entries, superseded values not merged yet included
+        return sum(len(keys) for keys, _ in self.runs)
+
+    def lookup(self, keys):
+        # return (found, values) for sorted unique keys, newest runs first
+        found = np.zeros(len(keys), dtype=bool)
+        values = np.zeros(len(keys), dtype=np.int64)
+        for run_keys, run_values in reversed(self.runs):
+            todo = np.flatnonzero(~found)
+            if len(todo) == 0:
+                break
+            idx = np.searchsorted(run_keys, keys[todo])
+            idx[idx == len(run_keys)] = 0
+            hit = run_keys[idx] == keys[todo]
+            found[todo[hit]] = True
+            values[todo[hit]] = run_values[idx[hit]]
+        return found, values
+
+    def add_run(self, keys, values):
+        self.runs.append((keys, values))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            keys = np.concatenate([older[0], newer[0]])
+            values = np.concatenate([older[1], newer[1]])
+            order = np.argsort(keys, kind="stable")
+            keys = keys[order]
+            values = values[order]
+            # keep the newer value of each key
+            last = np.append(keys[1:] != keys[:-1], True)
+            self.runs.append((keys[last], values[last]))
+
+    def filter(self, keys, values):
+        # return the mask of the (key, value) fingerprints to write, in order:
+        # a value is dropped if it is the last value written for its key
+        n = len(keys)
+        if n == 0:
+            return np.zeros(0, dtype=bool)
+        order = np.argsort(keys, kind="stable")
+        k = keys[order]
+        v = values[order]
+        first = np.append(True, k[1:] != k[:-1])
+        prev_found = ~first
+        prev = np.zeros(n, dtype=np.int64)
+        prev[1:] = v[:-1]
+        # the first occurrence of a key in the batch is compared with the store
+        found, stored = self.lookup(k[first])
+        prev_found[first] = found
+        prev[first] = stored
+        keep = np.empty(n, dtype=bool)
+        keep[order] = ~prev_found | (prev != v)
+        last = np.append(k[1:] != k[:-1], True)
+        self.add_run(k[last], v[last])
+        return keep
+
+
+class DedupWriter:
+    # file handle wrapper removing RDF lines whose value was already written
+    # for the same <subject> <predicate>. write() expects whole "<s> <p> object ." lines
+    # The lines of list_predicates (see list_predicates) are keyed on the whole triple:
+    # a list value is removed if the same triple was ever written.
+    # the filtering time is recorded as the "dedup" stage of metrics if given
+    def __init__(self, filehandle, store=None, metrics=None, list_predicates=()):
+        self.filehandle = filehandle
+        self.store = store if store is not None else FingerprintStore()
+        self.metrics = metrics
+        self.list_predicates = set(list_predicates)
+        self.written = 0
+        self.dropped = 0
+
+    def write(self, text):
+        start = time.perf_counter()
+        lines = [line for line in text.split("\n") if line != ""]
+        keys = np.empty(len(lines), dtype=np.int64)
+        values = np.empty(len(lines), dtype=np.int64)
+        for i, line in enumerate(lines):
+            # subject and predicate have no space
+            space = line.index(" ")
+            end = line.index(" ", space + 1)
+            if line[space + 1:end] in self.list_predicates:
+                keys[i] = hash(line)
+                values[i] = 0
+            else:
+                keys[i] = hash(line[:end])
+                values[i] = hash(line[end + 1:])
+        keep = self.store.filter(keys, values)
+        kept = [line for line, k in zip(lines, keep) if k]
+        self.written += len(kept)
+        self.dropped += len(lines) - len(kept)
+        if self.metrics is not None:
+            self.metrics.record("dedup", time.perf_counter() - start)
+            self.metrics.count("dropped", len(lines) - len(kept))
+        if len(kept) == 0:
+            return 0
+        return self.filehandle.write("\n".join(kept) + "\n")
+
+
+def list_predicates(template):
+    # predicates of the list lines ("*") of a template, for DedupWriter
+    # a predicate built from column values is not known before rendering and is not listed
+    predicates = set()
+    for line in template.splitlines():
+        m = re_tripple.match(line.strip())
+        if m and not line.startswith("#") and m.group(4) == "*" and "[" not in m.group(2):
+            predicates.add(m.group(2))
+    return predicates
+
+
+class UidWriter:
+    # file handle wrapper replacing the blank nodes by uids assigned locally, for the bulk loader:
+    # a new blank node gets the next uid (first_uid, first_uid + 1 ...) so the same CSV files
+    # written in the same order always get the same uids, consistent across chunks and files.
+    # xidmap is the "<_:xid>" -> "<0x..>" map used (e.g. a CompactXidMap), the new entries are
+    # also added to export if given (e.g. a SqliteXidMap read later by upload_csv).
+    # the substitution time is recorded as the "xid" stage of metrics if given
+    def __init__(self, filehandle, xidmap, first_uid=1, export=None, metrics=None):
+        self.filehandle = filehandle
+        self.xidmap = xidmap
+        self.next_uid = first_uid
+        self.export = export
+        self.metrics = metrics
+
+    def write(self, text):
+        # each blank node of the text is looked up once, new ones are numbered in order of appearance
+        start = time.perf_counter()
+        uids = {}
+        new = {}
+        for bn in dict.fromkeys(re_blank_bracket.findall(text)):
+            uid = self.xidmap.get(bn)
+            if uid is None:
+                uid = "<" + hex(self.next_uid) + ">"
+                self.next_uid += 1
+                new[bn] = uid
+            uids[bn] = uid
+        if len(new) > 0:
+            self.xidmap.update(new)
+            if self.export is not None:
+                self.export.update(new)
+        text = re_blank_bracket.sub(lambda match_obj: uids[match_obj.group(1)], text)
+        if self.metrics is not None:
+            self.metrics.record("xid", time.perf_counter() - start)
+            self.metrics.count("uids_assigned", len(new))
+        return self.filehandle.write(text)
+
+
+COMPRESSIONS = {None: "", "gzip": ".gz", "zstd": ".zst"}
+
+
+class RdfFileWriter:
+    # file handle writing RDF to one file or to shards of shard_lines lines / shard_bytes bytes
+    # (uncompressed size), optionally compressed with gzip or zstd.
+    # write() only queues the text: encoding, compression and I/O are done by a thread,
+    # at most queue_size blocks are waiting. write() expects whole lines.
+    #   RdfFileWriter("out.rdf", "gzip", shard_lines=1000000) -> out-000.rdf.gz, out-001.rdf.gz ...
+    def __init__(self, path, compression=None, shard_lines=None, shard_bytes=None, queue_size=16):
+        if compression not in COMPRESSIONS:
+            raise ValueError("unsupported compression " + str(compression))
+        if compression == "zstd":
+            try:
+                import zstandard
+            except ImportError as e:
+                raise ImportError("zstd compression requires the zstandard package") from e
+            self.zstd = zstandard.ZstdCompressor()
+        self.compression = compression
+        self.shard_lines = shard_lines
+        self.shard_bytes = shard_bytes
+        self.sharded = shard_lines is not None or shard_bytes is not None
+        if path.endswith(COMPRESSIONS[compression]):
+            path = path[: len(path) - len(COMPRESSIONS[compression])]
+        self.path = path
+        self.files = []  # paths of the files written
+        self.file = None
+        self.lines = 0
+        self.bytes = 0
+        self.error = None
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def shard_path(self):
+        # out.rdf -> out.rdf.gz or out-000.rdf.gz
+        path = self.path
+        if self.sharded:
+            root, ext = os.path.splitext(path)
+            path = f"{root}-{len(self.files):03d}{ext}"
+        return path + COMPRESSIONS[self.compression]
+
+    def open_next(self):
+        self.close_file()
+        path = self.shard_path()
+        if self.compression == "gzip":
+            self.file = gzip.open(path, "wb", compresslevel=6)
+        elif self.compression == "zstd":
+            self.file = self.zstd.stream_writer(open(path, "wb"))
+        else:
+            self.file = open(path, "wb")
+        self.files.append(path)
+        self.lines = 0
+        self.bytes = 0
+
+    def close_file(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def room(self, data):
+        # length of the beginning of data that fits in the current shard (whole lines)
+        size = len(data)
+        if self.shard_lines is not None and self.lines + data.count(b"\n") > self.shard_lines:
+            lines = data.splitlines(keepends=True)
+            size = sum(len(line) for line in lines[: self.shard_lines - self.lines])
+        if self.shard_bytes is not None and self.bytes + size > self.shard_bytes:
+            size = data.rfind(b"\n", 0, self.shard_bytes - self.bytes) + 1
+        if size == 0 and self.lines == 0:
+            # a line bigger than a shard
+            size = data.find(b"\n") + 1 or len(data)
+        return size
+
+    def write_block(self, data):
+        while len(data) > 0:
+            if self.file is None:
+                self.open_next()
+            size = self.room(data) if self.sharded else len(data)
+            if size == 0:
+                self.open_next()
+                continue
+            self.file.write(data[:size])
+            self.lines += data.count(b"\n", 0, size)
+            self.bytes += size
+            data = data[size:]
+
+    def run(self):
+        while True:
+            text = self.queue.get()
+            if text is None:
+                break
+            if self.error is None:
+                try:
+                    self.write_block(text.encode("utf-8"))
+                except Exception as e:
+                    self.error = e
+        try:
+            if len(self.files) == 0:
+                self.open_next()  # an empty output is still created
+            self.close_file()
+        except Exception as e:
+            if self.error is None:
+                self.error = e
+
+    def write(self, text):
+        if self.error is not None:
+            raise self.error
+        self.queue.put(text)
+        return len(text)
+
+    def close(self):
+        # wait for the queued RDF to be written
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+        return self.files
+
+
+def parse_rdf(rdf):
+  # (subject, predicate, object, isList) triples of RDF text lines, the lines not matching are dropped
+  for line in rdf.split("\n"):
+    m = re_tripple.match(line)
+    if m:
+      parts=m.groups()
+      yield (parts[0], parts[1], parts[2], parts[3] == "*")
+
+
+def tripleToStream(subject, predicate, obj, dedup, isList=False):
+  # streaming counterpart of addTripleToMap: return the N-Quad line or None if it is dropped
+  # a single value line is dropped if its value is the last one recorded for the <node id> <predicate>:
+  # unlike the map, a predicate set again to a previous value is kept so the last one sent wins.
+  # A list line is dropped if the same triple is among the recent keys, whatever the values written in between.
+  key = subject+" "+predicate
+  if isList:
+    line = key+" "+obj+" ."
+    return None if dedup.seen(line, True) else line
+  if not dedup.seen(key, obj):
+    return key+" "+obj+" ."
+  return None
+
+
+def rdfToStream(rdf, dedup):
+  # tripleToStream of a RDF text line
+  for subject, predicate, obj, isList in parse_rdf(rdf):
+    return tripleToStream(subject, predicate, obj, dedup, isList)
+  return None
+
+
+def addTripleToMap(rdfMap, subject, predicate, obj, isList):
   # applying the template to many tabular data lines may lead to the creation of the same predicate many time
   # e.g: if many line refer to a country object with a country code.
   # we maintain the map of <node id> <predicate> for non list predicates so we can remove duplicates
   # sending several times the the same RDF would not affect the data but this is done to improve performance
-  #m = re.match(r"(<\S+>)\s+(<\S+>)\s+(.*)\s+([.*])$",rdf)
-  if "\"nan\"" not in rdf:
-    m = re_tripple.match(rdf)
-    if m:
-      parts=m.groups()
-      key = parts[0]+" "+parts[1]
-      if parts[-1] == "*":
-        if key in rdfMap:
-          rdfMap[key].append(parts[2])
-        else:
-          rdfMap[key] = [parts[2]]
-      else:
-        rdfMap[key] = parts[2]
+  key = subject+" "+predicate
+  if isList:
+    if key in rdfMap:
+      rdfMap[key].append(obj)
+    else:
+      rdfMap[key] = [obj]
+  else:
+    rdfMap[key] = obj
+
+
+def addRdfToMap(rdfMap,rdf):
+  # addTripleToMap of RDF text lines
+  for triple in parse_rdf(rdf):
+    addTripleToMap(rdfMap, *triple)
 
 def substitute(match_obj, row, nospace=False):
     # substitute is used by substituteInTemplate
@@ -116,49 +471,102 @@ def substitute_in_value(match_obj, row):
     return substitute(match_obj, row, False)
 
 
+def functionValues(func, params):
+    # RDF values of a template function call once its parameters have been substituted
+    # split returns a value per element, the other functions a single value
+    if func == "geoloc":
+        params = params.split(",")
+        lat = float(params[0])
+        lng = float(params[1])
+        # fmt.Sprintf("\"{\\type\\\":\\\"Point\\\",\\\"coordinates\\\":[%s,%s]}\"^^<geo:geojson>", opMatch[2], opMatch[3]
+        return [f"\"{{'type':'Point','coordinates':[{lng:.8f},{lat:.8f}]}}\"^^<geo:geojson>"]
+    elif func == "datetime":
+        params = params.split(",")
+        date_string = params[0]
+        format = params[1]
+        return ['"'+format_datetime(date_string, format)+'"']
+    elif func == "randomDate":
+        params = params.split(",")
+        start = datetime.strptime(params[0], "%Y-%m-%d")
+        end = datetime.strptime(params[1], "%Y-%m-%d")
+        # Generate a random number of days between start and end
+        random_days = random.randint(0, (end - start).days)
+        # Add the random number of days to the start date
+        random_date = start + timedelta(days=random_days)
+        # Return the date in the desired format
+        return ['"'+random_date.strftime("%Y-%m-%d")+'"']
+    elif func == "split":
+        params = params.strip()
+        if (params.startswith('[') & params.endswith(']')):
+            params = params.replace("'",'"')
+            values = json.loads(params)
+            # json decodes the \n escaped in the cell, keep the value on one line
+            return ['"'+v.strip().replace("\n", r"\n")+'"' for v in values]
+        return ['"'+params+'"']
+
+    else:
+        raise ValueError("unsupported function " + func)
+
+
+def evaluateFunction(func, params, prefix, suffix):
+    # evaluate a template function call once its parameters have been substituted
+    # prefix and suffix are the parts of the RDF line around =func(params)
+    values = functionValues(func, params)
+    if func == "split":
+        return "".join(prefix+v+suffix+"\n" for v in values)
+    return prefix+values[0]+suffix
+
+
+@functools.lru_cache(maxsize=datetimeCacheSize)
+def format_datetime(date_string, format):
+    # datetime() conversion, values are often repeated in a column (days, hours)
+    return datetime.strptime(date_string, format).strftime("%Y-%m-%dT%H:%M:%S")
+
+
+# fixed datetime() formats parsed over whole columns by pd.to_datetime, with the pattern of the values
+# parsed the same way by strptime. Other formats and values are converted cell by cell.
+DATETIME_FORMATS = {
+    "%Y-%m-%d": r"\d{4}-\d{2}-\d{2}",
+    "%Y-%m-%dT%H:%M:%S": r"\d{4}-\d{2}-\d{2}T\d{2}:\d{2}:[0-5]\d",
+    "%Y-%m-%d %H:%M:%S": r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:[0-5]\d",
+    "%Y-%m-%d %H:%M:%S.%f": r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}:[0-5]\d\.\d{1,6}",
+    "%Y-%m-%d %H:%M": r"\d{4}-\d{2}-\d{2} \d{2}:\d{2}",
+    "%d/%m/%Y": r"\d{2}/\d{2}/\d{4}",
+    "%d/%m/%Y %H:%M": r"\d{2}/\d{2}/\d{4} \d{2}:\d{2}",
+    "%m/%d/%Y": r"\d{2}/\d{2}/\d{4}",
+}
+
+
+def format_datetime_column(values, format, mask):
+    # datetime() over a column of str values, for the rows of mask:
+    # returns the converted values and the mask of the rows converted,
+    # invalid values (e.g. 2021-02-30) are left to format_datetime
+    converted = np.full(len(values), None, dtype=object)
+    done = np.zeros(len(values), dtype=bool)
+    text = pd.Series(values, dtype=object)[mask]
+    text = text[text.str.fullmatch(DATETIME_FORMATS[format]).to_numpy(dtype=bool)]
+    if len(text) > 0:
+        dates = pd.to_datetime(text, format=format, errors="coerce")
+        dates = dates[dates.notna()]
+        rows = dates.index.to_numpy()
+        # ISO strings from numpy, faster than dt.strftime
+        converted[rows] = np.datetime_as_string(dates.to_numpy(), unit="s").astype(object)
+        done[rows] = True
+    return converted, done
+
+
+def apply_functions(rdf):
+    # evaluate the function calls of a RDF text line
+    return re_functions.sub(lambda match_obj: substituteFunctions(match_obj, None), rdf)
+
+
 def substituteFunctions(match_obj, row):
     # substitute is used by substituteInTemplate
     # evaluate function like <_:[HotelCode]> <Hotel.map>  =geoloc([LAT],[LONG]) .
     if match_obj.group() is not None:
-        func = match_obj.group(2)
-        if func == "geoloc":
-            params = match_obj.group(3).split(",")
-            lat = float(params[0])
-            lng = float(params[1])
-            # fmt.Sprintf("\"{\\type\\\":\\\"Point\\\",\\\"coordinates\\\":[%s,%s]}\"^^<geo:geojson>", opMatch[2], opMatch[3]
-            return match_obj.group(1)+f"\"{{'type':'Point','coordinates':[{lng:.8f},{lat:.8f}]}}\"^^<geo:geojson>"++match_obj.group(4)
-        elif func == "datetime":
-            params = match_obj.group(3).split(",")
-            date_string = params[0]
-            format = params[1]
-            date = datetime.strptime(date_string, format)
-            return match_obj.group(1)+'"'+date.strftime("%Y-%m-%dT%H:%M:%S")+'"'+match_obj.group(4)
-        elif func == "randomDate":
-            params = match_obj.group(3).split(",")
-            date_string = params[0]
-            format = params[1]
-            start = datetime.strptime(params[0], "%Y-%m-%d")
-            end = datetime.strptime(params[1], "%Y-%m-%d")
-            # Generate a random number of days between start and end
-            random_days = random.randint(0, (end - start).days)
-            # Add the random number of days to the start date
-            random_date = start + timedelta(days=random_days)
-            # Return the date in the desired format
-            return match_obj.group(1)+'"'+random_date.strftime("%Y-%m-%d")+'"'+match_obj.group(4)
-        elif func == "split":
-            params = match_obj.group(3).strip()
-            r = ""
-            if (params.startswith('[') & params.endswith(']')):
-                params = params.replace("'",'"')
-                values = json.loads(params)
-                for v in values:
-                    r += (match_obj.group(1)+'"'+v.strip()+'"'+match_obj.group(4))+"\n"
-            else:
-                r = match_obj.group(1)+'"'+params+'"'+match_obj.group(4)+"\n"
-            return r
-
-        else:
-            raise ValueError("unsupported function " + func)
+        return evaluateFunction(
+            match_obj.group(2), match_obj.group(3), match_obj.group(1), match_obj.group(4)
+        )
 
 
 re_column = re.compile(r"(\[[\w .,|]+\])")
@@ -168,11 +576,17 @@ re_uid = re.compile(r"<_:[^>]*?(\[[^\]]+\])(?:[^>]*?(\[[^\]]+\]))?[^>]*?>")
 re_functions = re.compile(r'(^[^"]*)=(\w+)\(([^)]+)?\)(.*)$')
 
 
+def is_null(value):
+    # missing cell: NaN (empty CSV cell), None, pd.NA or NaT. The rows of a template line
+    # referring to a missing cell are skipped
+    return type(value) is not str and pd.isna(value) is True
+
+
 def substituteInTemplate(template, row):
     fields = re_column.findall(template)
     for field in fields:
         column = field[1:-1].split(",")[0]
-        if str(row[column]) == "nan":
+        if is_null(row[column]):
             return None
     # substitute all instances of [<column name>,<function>] in the template by corresponding value from the row map
     subst1 = re_uid.sub(lambda match_obj: substitute_in_uid(match_obj, row), template)
@@ -185,42 +599,424 @@ def substituteInTemplate(template, row):
     return subst3
 
 
-def transformDataFrame(df, template):
-    # Split the template lines once and filter out comments
-    valid_templates = [line for line in template.splitlines() if not line.startswith("#")]
+# Compiled templates
+#
+# substituteInTemplate re-parses the template line for every row.
+# compile_template parses each template line once into literal segments and slots,
+# the rows are then rendered by concatenation.
+# The output is the same as substituteInTemplate.
+
+SLOT_MARK = "\x00"  # never part of a column name, used to locate slots while compiling
+SLOT_TRANSFORMS = ("nospace", "toUpper", "toLower")
+re_nonword = re.compile(r"\W")
+re_slot_in_function_name = re.compile(r"=[\w\x00]*\x00[\w\x00]*\(")
+# subject, predicate and start of the object before a function call, end of the object and terminator after it
+re_rdf_head = re.compile(r"(<\S+>)\s+(<\S+>)\s+(.*)$")
+re_rdf_tail = re.compile(r"(.*)\s([.*])$")
+
+
+class TemplateSlot:
+    # a [column] or [column,transform] reference
+    # slots in blank nodes (in_uid) get \W replaced by _
+    def __init__(self, column, transform=None, in_uid=False):
+        if transform is not None and transform not in SLOT_TRANSFORMS:
+            raise ValueError("unsupported function " + transform)
+        self.column = column
+        self.transform = transform
+        self.in_uid = in_uid
+
+    def render(self, value):
+        val = str(value).replace('"', r"\"").replace("\n", r"\n")
+        if self.in_uid:
+            val = re_nonword.sub("_", val)
+        if self.transform == "nospace":
+            val = val.replace(" ", "_")
+        elif self.transform == "toUpper":
+            val = val.upper()
+        elif self.transform == "toLower":
+            val = val.lower()
+        return val
+
+    def render_column(self, values):
+        # same as render on a Series of str values, returns an object array
+        val = values.str.replace('"', r"\"", regex=False).str.replace("\n", r"\n", regex=False)
+        if self.in_uid:
+            val = val.str.replace(r"\W", "_", regex=True)
+        if self.transform == "nospace":
+            val = val.str.replace(" ", "_", regex=False)
+        elif self.transform == "toUpper":
+            val = val.str.upper()
+        elif self.transform == "toLower":
+            val = val.str.lower()
+        return val.to_numpy(dtype=object)
+
+
+class TemplateLine:
+    # one RDF template line compiled into parts: str for literals, int for slot indexes
+    # if the line calls a function, parts are split into prefix, params and suffix
+    # A line <subject> <predicate> object . is rendered as (subject, predicate, object, isList) triples
+    # without parsing the RDF text: subject, predicate and object are parts, the object of a function
+    # line is the (text before, text after) the function value. Other lines are rendered as text and parsed.
+    def __init__(self, source, nan_columns, parts, function=None):
+        self.source = source
+        self.nan_columns = nan_columns
+        self.parts = parts
+        self.function = function  # (prefix, name, params, suffix) or None
+        self.value_slots = set()
+        # the function regex is applied after substitution in substituteInTemplate:
+        # data containing those characters may add or hide a function call,
+        # in that case the line is rendered as text and the regex is applied
+        self.unsafe_chars = '"=()' if function is not None else "="
+        self.always_regex = False
+        self.datetime_column = None  # (slot, format) of =datetime([column],format) in DATETIME_FORMATS
+        self.subject = None  # None if the line is rendered as text
+        self.predicate = None
+        self.object = None
+        self.is_list = False
+
+    def join(self, parts, values):
+        return "".join(p if type(p) is str else values[p] for p in parts)
+
+    def is_unsafe(self, values):
+        return any(c in values[idx] for idx in self.value_slots for c in self.unsafe_chars)
+
+    def render(self, values):
+        # return the triples of the line
+        if self.subject is None or self.always_regex or self.is_unsafe(values):
+            return list(parse_rdf(self.render_text(values)))
+        subject = self.join(self.subject, values)
+        predicate = self.join(self.predicate, values)
+        if self.function is None:
+            return [(subject, predicate, self.join(self.object, values), self.is_list)]
+        params = self.function[2]
+        return self.function_triples(subject, predicate, self.join(params, values) if params is not None else None)
+
+    def render_text(self, values):
+        # RDF text of the line, as substituteInTemplate
+        if self.always_regex or self.is_unsafe(values):
+            return apply_functions(self.join(self.parts, values))
+        if self.function is None:
+            return self.join(self.parts, values)
+        prefix, name, params, suffix = self.function
+        return evaluateFunction(
+            name,
+            self.join(params, values) if params is not None else None,
+            self.join(prefix, values),
+            self.join(suffix, values),
+        )
+
+    def function_triples(self, subject, predicate, params):
+        before, after = self.object
+        return [
+            (subject, predicate, before + value + after, self.is_list)
+            for value in functionValues(self.function[1], params)
+        ]
+
+    def evaluate(self, call):
+        # triples of a row left by render_column, call is one of
+        #   ("regex", text) text to apply the function regex to, as substituteInTemplate
+        #   ("text", text) RDF text
+        #   ("triples", subject, predicate, params) function line rendered as triples
+        #   ("function", prefix, params, suffix) other function line
+        kind = call[0]
+        if kind == "regex":
+            return list(parse_rdf(apply_functions(call[1])))
+        if kind == "text":
+            return list(parse_rdf(call[1]))
+        if kind == "triples":
+            return self.function_triples(*call[1:])
+        _, prefix, params, suffix = call
+        return list(parse_rdf(evaluateFunction(self.function[1], params, prefix, suffix)))
+
+    def join_columns(self, parts, columns, n):
+        out = np.full(n, "", dtype=object)
+        for p in parts:
+            out = out + (p if type(p) is str else columns[p])
+        return out
+
+    def render_column(self, columns, keep):
+        # render the line for all rows at once, columns are the rendered slots
+        # returns the lists of subjects, predicates and objects: the object of a row is a str for a triple,
+        # None for a skipped row or a call tuple for a row needing an evaluation (see evaluate)
+        n = len(keep)
+        objects = np.full(n, None, dtype=object)
+        subjects = predicates = objects
+        if self.always_regex:
+            unsafe = keep
+        else:
+            unsafe = np.zeros(n, dtype=bool)
+            pattern = "[" + re.escape(self.unsafe_chars) + "]"
+            for idx in self.value_slots:
+                unsafe |= pd.Series(columns[idx], dtype=object).str.contains(pattern).to_numpy(dtype=bool)
+            unsafe &= keep
+        safe = keep & ~unsafe
+        if unsafe.any():
+            text = self.join_columns(self.parts, columns, n)
+            for i in np.flatnonzero(unsafe):
+                objects[i] = ("regex", text[i])
+        if not safe.any():
+            pass
+        elif self.subject is not None:
+            subjects = self.join_columns(self.subject, columns, n)
+            predicates = self.join_columns(self.predicate, columns, n)
+            if self.function is None:
+                objects[safe] = self.join_columns(self.object, columns, n)[safe]
+            else:
+                params = self.function[2]
+                params = self.join_columns(params, columns, n) if params is not None else np.full(n, None, dtype=object)
+                if self.datetime_column is not None:
+                    slot, format = self.datetime_column
+                    dates, done = format_datetime_column(columns[slot], format, safe)
+                    before, after = self.object
+                    objects[done] = before + '"' + dates[done] + '"' + after
+                    safe = safe & ~done
+                for i in np.flatnonzero(safe):
+                    objects[i] = ("triples", subjects[i], predicates[i], params[i])
+        elif self.function is None:
+            text = self.join_columns(self.parts, columns, n)
+            for i in np.flatnonzero(safe):
+                objects[i] = ("text", text[i])
+        else:
+            prefix, _, params, suffix = self.function
+            prefix = self.join_columns(prefix, columns, n)
+            params = self.join_columns(params, columns, n) if params is not None else np.full(n, None, dtype=object)
+            suffix = self.join_columns(suffix, columns, n)
+            for i in np.flatnonzero(safe):
+                objects[i] = ("function", prefix[i], params[i], suffix[i])
+        return subjects.tolist(), predicates.tolist(), objects.tolist()
+
+
+class CompiledTemplate:
+    def __init__(self, template):
+        self.slots = []
+        self.slot_index = {}
+        self.lines = [
+            self.compile_line(line)
+            for line in template.splitlines()
+            if not line.startswith("#")
+        ]
+        self.nan_columns = list(
+            dict.fromkeys(c for line in self.lines for c in line.nan_columns)
+        )
+
+    def add_slot(self, token, in_uid):
+        fieldAndFunc = token[1:-1].split(",")
+        transform = fieldAndFunc[1] if len(fieldAndFunc) > 1 else None
+        key = (fieldAndFunc[0], transform, in_uid)
+        if key not in self.slot_index:
+            self.slot_index[key] = len(self.slots)
+            self.slots.append(TemplateSlot(fieldAndFunc[0], transform, in_uid))
+        return self.slot_index[key]
+
+    def mark(self, token, in_uid):
+        return SLOT_MARK + str(self.add_slot(token, in_uid)) + SLOT_MARK
+
+    def mark_uid(self, match_obj):
+        # same replacement order as substitute(): every occurrence of a token in the blank node
+        replaced = match_obj.group(0)
+        for i in range(1, match_obj.lastindex + 1):
+            token = match_obj.group(i)
+            replaced = replaced.replace(token, self.mark(token, True))
+        return replaced
+
+    def split_marks(self, text):
+        # "a\x000\x00b" -> ["a", 0, "b"]
+        parts = []
+        for i, p in enumerate(text.split(SLOT_MARK)):
+            if i % 2 == 1:
+                parts.append(int(p))
+            elif p != "":
+                parts.append(p)
+        return parts
+
+    def compile_line(self, template):
+        nan_columns = [
+            field[1:-1].split(",")[0] for field in re_column.findall(template)
+        ]
+        marked = re_uid.sub(self.mark_uid, template)
+        marked = re_column.sub(lambda m: self.mark(m.group(0), False), marked)
+        function = None
+        m = re_functions.match(marked)
+        if m:
+            function = (
+                self.split_marks(m.group(1)),
+                m.group(2),
+                self.split_marks(m.group(3)) if m.group(3) is not None else None,
+                self.split_marks(m.group(4)),
+            )
+        line = TemplateLine(template, nan_columns, self.split_marks(marked), function)
+        line.value_slots = {
+            p for p in line.parts if type(p) is int and not self.slots[p].in_uid
+        }
+        if function is not None and function[1] == "datetime" and function[2] is not None:
+            params = function[2]
+            if (
+                len(params) == 2 and type(params[0]) is int and type(params[1]) is str
+                and params[1][1:] in DATETIME_FORMATS and params[1].count(",") == 1
+                and params[1].startswith(",")
+            ):
+                line.datetime_column = (params[0], params[1][1:])
+        # a slot between = and ( would be part of the function name
+        line.always_regex = re_slot_in_function_name.search(marked) is not None or (
+            function is None and "=" in marked.replace(SLOT_MARK, "")
+            and len(line.value_slots) > 0
+        )
+        # triples are split as re_tripple would split the rendered line:
+        # the object must not start with a slot, whose value could start with a space
+        if function is None:
+            t = re_tripple.match(marked)
+            if t and not t.group(3).startswith(SLOT_MARK):
+                self.set_triple(line, t.group(1), t.group(2), self.split_marks(t.group(3)), t.group(4))
+        else:
+            head = re_rdf_head.match(m.group(1))
+            tail = re_rdf_tail.match(m.group(4))
+            if head and tail and SLOT_MARK not in head.group(3) + tail.group(1):
+                self.set_triple(line, head.group(1), head.group(2), (head.group(3), tail.group(1)), tail.group(2))
+        return line
+
+    def set_triple(self, line, subject, predicate, obj, end):
+        # the slots of the subject and predicate must be blank node slots: values without spaces
+        subject = self.split_marks(subject)
+        predicate = self.split_marks(predicate)
+        if any(type(p) is int and not self.slots[p].in_uid for p in subject + predicate):
+            return
+        line.subject = subject
+        line.predicate = predicate
+        line.object = obj
+        line.is_list = end == "*"
+
+    def uses_column(self, column):
+        return column in self.nan_columns or any(
+            slot.column == column for slot in self.slots
+        )
+
+    def render_row(self, row):
+        # return the triples of the template for one row, like substituteInTemplate on each line
+        raw = {c: row[c] for c in self.nan_columns}
+        isnull = {c: is_null(v) for c, v in raw.items()}
+        values = [None] * len(self.slots)
+        triples = []
+        for line in self.lines:
+            if any(isnull[c] for c in line.nan_columns):
+                continue
+            for p in line.parts:
+                if type(p) is int and values[p] is None:
+                    slot = self.slots[p]
+                    value = raw[slot.column] if slot.column in raw else row[slot.column]
+                    values[p] = slot.render(value)
+            triples.extend(line.render(values))
+        return triples
+
+
+    def column_strings(self, df, column):
+        # str() of each value as in the row by row rendering
+        # LINENUMBER is the index of the row
+        values = df.index if column == "LINENUMBER" else df[column]
+        return pd.Series(list(map(str, values.tolist())), index=df.index, dtype=object)
+
+    def render_frame(self, df):
+        # vectorized rendering: every line is rendered over whole columns,
+        # triples are then yielded row by row, in the order of render_row
+        n = len(df)
+        if n == 0:
+            return
+        strings = {}
+        for c in self.nan_columns + [slot.column for slot in self.slots]:
+            if c not in strings:
+                strings[c] = self.column_strings(df, c)
+        isnull = {
+            c: np.asarray(pd.isna(df.index if c == "LINENUMBER" else df[c]), dtype=bool)
+            for c in self.nan_columns
+        }
+        used = {p for line in self.lines for p in line.parts if type(p) is int}
+        columns = {
+            idx: self.slots[idx].render_column(strings[self.slots[idx].column])
+            for idx in used
+        }
+        outputs = []
+        for line in self.lines:
+            keep = np.ones(n, dtype=bool)
+            for c in line.nan_columns:
+                keep &= ~isnull[c]
+            outputs.append(line.render_column(columns, keep))
+        for i in range(n):
+            for line, (subjects, predicates, objects) in zip(self.lines, outputs):
+                obj = objects[i]
+                if obj is None:
+                    continue
+                if type(obj) is str:
+                    yield (subjects[i], predicates[i], obj, line.is_list)
+                else:
+                    yield from line.evaluate(obj)
 
-    rdf_map = {}
 
-    # Iterate over rows more efficiently using apply
-    def process_row(row):
-        # Add the LINE_NUMBER to the row
-        row["LINENUMBER"] = row.name  # .name is the index of the row in apply
-        # Process each valid template line
-        for rdftemplate in valid_templates:
-            rdf = substituteInTemplate(rdftemplate, row)
-            if rdf is not None:
-                for r in rdf.split("\n"):
-                    addRdfToMap(rdf_map, r)
+    def render_rows(self, df):
+        # row by row rendering, yield the triples of each row
+        # rows are read from df.to_numpy() like DataFrame.apply(axis=1) does
+        if len(df) == 0:
+            return
+        if self.uses_column("LINENUMBER"):
+            # Add the LINE_NUMBER to a copy of the row, it gets the dtype of the row
+            for index, row in df.iterrows():
+                row["LINENUMBER"] = index
+                yield from self.render_row(row)
+            return
+        columns = dict.fromkeys(self.nan_columns + [slot.column for slot in self.slots])
+        positions = [(c, df.columns.get_loc(c)) for c in columns]
+        for values in df.to_numpy():
+            yield from self.render_row({c: values[i] for c, i in positions})
 
-    # Apply processing row-wise
-    df.apply(process_row, axis=1)
+    def render(self, df, vectorized=False):
+        if vectorized:
+            return self.render_frame(df)
+        return self.render_rows(df)
+
+
+def compile_template(template):
+    return CompiledTemplate(template)
+
+
+def transformDataFrame(df, template, vectorized=False):
+    # vectorized renders the template over whole columns instead of row by row.
+    # Values are converted with str() per column: in a frame with only numeric columns,
+    # rows would convert ints to float, vectorized keeps "1" instead of "1.0"
+    compiled = compile_template(template)
+
+    rdf_map = {}
+    for subject, predicate, obj, isList in compiled.render(df, vectorized):
+        addTripleToMap(rdf_map, subject, predicate, obj, isList)
 
     return rdf_map
 
 
-def df_to_rdf_map(df, template):
+def df_to_rdf_map(df, template, vectorized=False):
 
     # rdf_map will contains key = subject predicate ; value = object
     # example:
     #   key '<_:3150-JP> <dgraph.type>'
     #   of rdf_map['<_:3150-JP> <dgraph.type>'] : '"Company"'
 
-    rdf_map = transformDataFrame(df, template)
+    rdf_map = transformDataFrame(df, template, vectorized)
     return rdf_map
 
 
-def df_to_rdffile(df, template, filehandle=sys.stdout, xidmap=None):
+def df_to_rdf_stream(df, template, vectorized=False, dedup=None):
+    # yield N-Quad lines as the rows are rendered, instead of building the rdf_map
+    # dedup keeps the recent triples to drop duplicates (RecentKeys by default)
+    if dedup is None:
+        dedup = RecentKeys()
+    compiled = compile_template(template)
+    for subject, predicate, obj, isList in compiled.render(df, vectorized):
+        line = tripleToStream(subject, predicate, obj, dedup, isList)
+        if line is not None:
+            yield line
+
+
+def df_to_rdffile(df, template, filehandle=sys.stdout, xidmap=None, vectorized=False, stream=False, dedup=None):
     if xidmap is None:
         xidmap = {}
-    rdf_map = df_to_rdf_map(df, template)
+    if stream:
+        rdf_stream = df_to_rdf_stream(df, template, vectorized, dedup)
+        return rdf_stream_to_file(rdf_stream, xidmap, filehandle)
+    rdf_map = df_to_rdf_map(df, template, vectorized)
     return rdf_map_to_file(rdf_map, xidmap, filehandle)
@@ -1,35 +1,35 @@
+import argparse
+import itertools
 import json
 import os
+import queue
+import random
 import re
 import sys
+import threading
+import time
 import grpc
 import pandas as pd
 import pydgraph
+from csv_to_rdf import parse_size
+from metrics import ProgressReporter, metrics
 from rdf_lib import df_to_rdf_map, rdf_map_to_rdf
+from xidmap import CompactXidMap, SqliteXidMap, xid_schema
 
-if len(sys.argv) < 2:
-    print("Usage: upload_csv.py <directory>")
-    print(
-        "<directory> is the directory containing the CSV files and their associated templates"
-    )
-    print(
-        "The script uses Dgraph grpc endpoint defined in DGRAPH_GRPC environment variable or localhost:9080"
-    )
-    print(
-        "If the grpc endpoint is a cloud instance, the scrip uses the key set in DGRAPH_ADMIN_KEY"
-    )
-    sys.exit(1)
 
-csvdir = sys.argv[1]
+def getEndpoint():
+    if "DGRAPH_GRPC" in os.environ:
+        return os.environ["DGRAPH_GRPC"]
+    return "localhost:9080"
+
 
+def getEndpoints():
+    # DGRAPH_GRPC may list several Alpha endpoints separated by commas
+    return [e.strip() for e in getEndpoint().split(",") if e.strip() != ""]
 
-# to upload to a self-hosted env, unset ADMIN_KEY and set DGRAPH_GRPC
-def getClient():
-    if "DGRAPH_GRPC" in os.environ:
-        dgraph_grpc = os.environ["DGRAPH_GRPC"]
-    else:
-        dgraph_grpc = "localhost:9080"
 
+# to upload to a self-hosted env, unset ADMIN_KEY and set DGRAPH_GRPC
+def getClientStub(dgraph_grpc):
     if "cloud.dgraph.io" in dgraph_grpc:
         assert "DGRAPH_ADMIN_KEY" in os.environ, "DGRAPH_ADMIN_KEY must be set"
         APIAdminKey = os.environ["DGRAPH_ADMIN_KEY"]
@@ -46,18 +46,56 @@ def getClient():
     else:
         client_stub = pydgraph.DgraphClientStub(dgraph_grpc)
         print("local client " + dgraph_grpc)
-    client = pydgraph.DgraphClient(client_stub)
-    return client
-
-
-sliceSize = 5000  # mutate every sliceSize RDF lines
-
-
-def readXidMapFromDgraph(client, predicate="xid"):
+    return client_stub
+
+
+class ClientPool:
+    # fixed number of gRPC channels opened once for the whole load, spread over the endpoints of DGRAPH_GRPC.
+    # txn() and alter() use the channels round-robin, so the pool is used in place of a DgraphClient,
+    # including from several threads (a channel multiplexes concurrent requests).
+    # close() closes all the channels.
+    def __init__(self, size=None):
+        endpoints = getEndpoints()
+        if size is None:
+            size = len(endpoints)
+        self.stubs = [getClientStub(endpoints[i % len(endpoints)]) for i in range(size)]
+        self.clients = [pydgraph.DgraphClient(stub) for stub in self.stubs]
+        self.counter = itertools.count()
+
+    def get(self):
+        return self.clients[next(self.counter) % len(self.clients)]
+
+    def txn(self, *args, **kwargs):
+        return self.get().txn(*args, **kwargs)
+
+    def alter(self, operation):
+        return self.get().alter(operation)
+
+    def close(self):
+        for stub in self.stubs:
+            stub.close()
+        self.stubs = []
+        self.clients = []
+
+
+batchSize = 1 << 20  # bytes of RDF sent by the first mutations, then adapted to the latency
+minBatchSize = 64 << 10
+maxBatchSize = 64 << 20
+targetLatency = 1000  # ms, mutations are made bigger while they take less time
+upsertSize = 1000  # maximum number of xids allocated by an upsert
+pendingSlices = 4  # slices ready to mutate while the next ones get their uids
+chunkSize = 100000  # CSV lines read and converted at once
+abortTries = 5  # tries of a mutation aborted by a conflicting transaction
+abortBackoff = 0.1  # seconds, maximum wait before the first retry, doubled at each try
+
+
+def readXidMapFromDgraph(client, predicate="xid", xidmap=None):
     # xid from dgraph by batch (pagination)
-    # return a map of xid -> uid
+    # return a map of xid -> uid, kept compact in memory (CompactXidMap)
+    # if xidmap is given (e.g. a SqliteXidMap), it is updated page by page
 
-    xidmap = dict({})
+    if xidmap is None:
+        xidmap = CompactXidMap()
     txn = client.txn(read_only=True)
     batch = 10000
     after = ""
@@ -80,8 +118,9 @@ def readXidMapFromDgraph(client, predicate="xid"):
             )
             res = txn.query(query)
             data = json.loads(res.json)
-            for e in data["xidmap"]:
-                xidmap["<" + e[predicate] + ">"] = "<" + e["uid"] + ">"
+            xidmap.update(
+                {"<" + e[predicate] + ">": "<" + e["uid"] + ">" for e in data["xidmap"]}
+            )
             if len(data["xidmap"]) < batch:
                 break
             after = ",after:" + data["xidmap"][-1]["uid"]
@@ -95,9 +134,16 @@ re_blank_node = re.compile(r"<(_:\S+)>")  # used for findall
 
 
 def allocate_uid(client, body, xidmap):
+    # allocate the uids of the blank nodes of body missing from xidmap
+    # by upserts of at most upsertSize xids
     r = re.findall(re_blank_node, body)
-    if len(r) > 0:
-        blank = set(r)
+    blank = [n for n in set(r) if "<" + n + ">" not in xidmap]
+    for start in range(0, len(blank), upsertSize):
+        upsert_xids(client, blank[start : start + upsertSize], xidmap)
+
+
+def upsert_xids(client, blank, xidmap):
+    if len(blank) > 0:
         # upsert
 
         query_list = ["{"]
@@ -118,16 +164,21 @@ def allocate_uid(client, body, xidmap):
             txn.commit()
             #  new uid for xid are in res.uids
             #  existing uid for xid are res.json payload
+            allocated = {}
             for n in res.uids:
                 idx = n[n.index("(") + 1 : n.index(")")]
-                xidmap["<" + blank_map[idx] + ">"] = "<" + res.uids[n] + ">"
+                allocated["<" + blank_map[idx] + ">"] = "<" + res.uids[n] + ">"
 
             queries = json.loads(res.json)
             for idx in queries:
                 if len(queries[idx]) > 0:
-                    xidmap["<" + blank_map[idx] + ">"] = (
+                    allocated["<" + blank_map[idx] + ">"] = (
                         "<" + queries[idx][0]["uid"] + ">"
                     )
+            # one update for the batch, xidmap may be a SqliteXidMap
+            xidmap.update(allocated)
+            metrics.count("upserts")
+            metrics.count("xids_allocated", len(res.uids))
         finally:
             txn.discard()
 
@@ -141,23 +192,30 @@ def substituteXid(match_obj, xidmap):
         return bn
 
 
-def mutate_rdf(nquads):
+def mutate_rdf(client, nquads):
     ret = {}
     if len(nquads) > 0:
-        client = getClient()
-        print("mutate rdf \n")
         body = "\n".join(nquads)
 
-        tries = 3
+        tries = abortTries
         for i in range(tries):
             txn = client.txn()
             try:
-                res = txn.mutate(set_nquads=body)
-                txn.commit()
+                with metrics.timer("mutate"):
+                    res = txn.mutate(set_nquads=body)
+                with metrics.timer("commit"):
+                    txn.commit()
                 ret["nquads"] = (len(nquads),)
                 ret["total_ns"] = res.latency.total_ns
+                metrics.count("mutations")
+                metrics.count("triples", len(nquads))
             except pydgraph.errors.AbortedError:
                 print("AbortedError %s" % i)
+                ret["aborts"] = i + 1
+                metrics.count("aborts")
+                # jittered exponential backoff, so conflicting workers do not retry together
+                if i < tries - 1:
+                    time.sleep(random.uniform(0, abortBackoff * 2**i))
                 continue
             except Exception as inst:
                 print(type(inst))  # the exception type
@@ -171,42 +229,229 @@ def mutate_rdf(nquads):
     return ret
 
 
-def split_mutate(client, body, xidmap):
-    b2 = re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, xidmap), body)
-    allocate_uid(client, b2, xidmap)
-    body = re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, xidmap), b2)
+class AdaptiveBatcher:
+    # size in bytes of the mutations sent to Dgraph, adapted to the server latency:
+    # it grows by 25% while full batches take less than target_ms, is reduced proportionally
+    # when a mutation is slower, and halved when a mutation is aborted or fails (e.g. a timeout).
+    # target_ms=0 keeps the initial size.
+    def __init__(self, size=batchSize, target_ms=targetLatency, minimum=minBatchSize, maximum=maxBatchSize):
+        self.size = size
+        self.target_ns = target_ms * 1000000
+        self.minimum = minimum
+        self.maximum = maximum
+        self.lock = threading.Lock()
+
+    def record(self, nbytes, res, elapsed_ns):
+        # res is the result of mutate_rdf for a batch of nbytes, sent in elapsed_ns
+        if self.target_ns == 0:
+            return
+        latency_ns = res.get("total_ns", elapsed_ns)
+        with self.lock:
+            if "nquads" not in res or res.get("aborts", 0) > 0:
+                size = self.size // 2
+            elif latency_ns > self.target_ns:
+                size = int(self.size * self.target_ns / latency_ns)
+            elif nbytes >= self.size // 2:
+                size = int(self.size * 1.25)
+            else:
+                # the batch was not full, its latency says nothing about the size
+                size = self.size
+            self.size = min(self.maximum, max(self.minimum, size))
+
+    def batches(self, lines):
+        # split the lines in batches of about size bytes,
+        # the values of a list predicate (same subject and predicate) are not split
+        batch = []
+        nbytes = 0
+        for line in lines:
+            if nbytes > 0 and nbytes + len(line) + 1 > self.size:
+                key = line[: line.find(" ", line.find(" ") + 1)]
+                if not batch[-1].startswith(key + " "):
+                    yield batch, nbytes
+                    batch = []
+                    nbytes = 0
+            batch.append(line)
+            nbytes += len(line) + 1
+        if len(batch) > 0:
+            yield batch, nbytes
+
+
+class MutationPipeline:
+    # mutations are sent by worker threads while the next slices get their uids:
+    # uid allocation runs ahead of the data mutations, at most queue_size slices are waiting per worker.
+    # With several workers, the RDF of a slice are partitioned by subject, so the triples of
+    # a subject are always sent by the same worker and never in two concurrent transactions.
+    # The queued slices are merged or split in mutations of the size given by the batcher.
+    # xidmap is only used by the caller thread.
+    # wait() returns when the queued mutations are done, failed counts the mutations given up.
+    def __init__(self, client, queue_size=pendingSlices, workers=1, batcher=None):
+        self.client = client
+        self.batcher = batcher if batcher is not None else AdaptiveBatcher()
+        self.error = None
+        self.failed = 0
+        self.lock = threading.Lock()  # failed is counted by the worker threads
+        self.queues = [queue.Queue(maxsize=queue_size) for _ in range(workers)]
+        self.threads = [threading.Thread(target=self.run, args=(q,), daemon=True) for q in self.queues]
+        for thread in self.threads:
+            thread.start()
+
+    def run(self, nquads_queue):
+        stop = False
+        while not stop:
+            nquads = nquads_queue.get()
+            items = 1
+            lines = []
+            nbytes = 0
+            # merge the slices already queued up to the batch size
+            while nquads is not None:
+                lines.extend(line for line in nquads if line != "")
+                nbytes += sum(len(line) + 1 for line in nquads)
+                if nbytes >= self.batcher.size:
+                    break
+                try:
+                    nquads = nquads_queue.get_nowait()
+                    items += 1
+                except queue.Empty:
+                    break
+            stop = nquads is None
+            if self.error is None:
+                try:
+                    self.send(lines)
+                except Exception as e:
+                    self.error = e
+            for _ in range(items):
+                nquads_queue.task_done()
+
+    def send(self, lines):
+        for batch, nbytes in self.batcher.batches(lines):
+            start = time.perf_counter_ns()
+            all_res = mutate_rdf(self.client, batch)
+            self.batcher.record(nbytes, all_res, time.perf_counter_ns() - start)
+            if "nquads" not in all_res:
+                with self.lock:
+                    self.failed += 1
+                metrics.count("failed")
+
+    def partition(self, nquads):
+        # split the lines by subject uid, one list per worker
+        parts = [[] for _ in self.queues]
+        for line in nquads:
+            if line != "":
+                parts[hash(line[: line.find(" ")]) % len(parts)].append(line)
+        return parts
+
+    def put(self, nquads):
+        if self.error is not None:
+            raise self.error
+        if len(self.queues) == 1:
+            self.queues[0].put(nquads)
+            return
+        for nquads_queue, part in zip(self.queues, self.partition(nquads)):
+            if len(part) > 0:
+                nquads_queue.put(part)
+
+    def wait(self):
+        for nquads_queue in self.queues:
+            nquads_queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        # wait for the queued mutations
+        for nquads_queue in self.queues:
+            nquads_queue.put(None)
+        for thread in self.threads:
+            thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def resolve_xids(client, body, xidmap):
+    # replace the blank nodes of body by their uid, allocating the missing ones
+    with metrics.timer("xid"):
+        b2 = re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, xidmap), body)
+    with metrics.timer("allocate"):
+        allocate_uid(client, b2, xidmap)
+    with metrics.timer("xid"):
+        return re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, xidmap), b2)
+
+
+def split_mutate(client, body, xidmap, pipeline=None):
+    body = resolve_xids(client, body, xidmap)
     # no more blank node at this point
     # cpu_count = mp.cpu_count()
     nquads = body.split("\n")
-    all_res = mutate_rdf(nquads)
-    print(all_res)
-
-    # multiprocess approach
-    # cpu_count = 1
-    # split = np.array_split(nquads, cpu_count)
-    # we may split in the middle of a predicate list
-    # this may cause AbortedTransaction
-    # We handle this by retrying the transaction
-    # we may do better by not splitting in list-> to do
-
-    # with mp.Pool(cpu_count) as pool:
-    #  all_res = pool.map(mutate_rdf, split)
-    #  print(all_res)
+    if pipeline is not None:
+        pipeline.put(nquads)
+        return
+    all_res = mutate_rdf(client, nquads)
+    if "nquads" not in all_res:
+        metrics.count("failed")
+
+
+def rdf_map_to_dgraph(rdfMap, xidmap, client, pipelined=True, workers=1, pipeline=None):
+    # with pipelined, the mutation of a slice overlaps the uid allocation of the next ones
+    # and the mutations are sent by worker threads in parallel
+    # a pipeline given by the caller is reused and left open
+    own_pipeline = pipeline is None and pipelined
+    if own_pipeline:
+        pipeline = MutationPipeline(client, workers=workers)
 
-
-def rdf_map_to_dgraph(rdfMap, xidmap, client):
     def f(body):
-        return split_mutate(client, body, xidmap)
+        return split_mutate(client, body, xidmap, pipeline)
 
-    rdf_map_to_rdf(rdfMap, f)
+    try:
+        rdf_map_to_rdf(rdfMap, f)
+    finally:
+        if own_pipeline:
+            pipeline.close()
     return xidmap
 
 
-def df_to_dgraph(df, template, client, xidpredicate="xid", xidmap=None):
+def df_to_dgraph(df, template, client, xidpredicate="xid", xidmap=None, vectorized=False, workers=1, pipeline=None):
     if xidmap is None:
         xidmap = readXidMapFromDgraph(client, xidpredicate)
-    rdfMap = df_to_rdf_map(df, template)
-    return rdf_map_to_dgraph(rdfMap, xidmap, client)
+    with metrics.timer("render"):
+        rdfMap = df_to_rdf_map(df, template, vectorized)
+    return rdf_map_to_dgraph(rdfMap, xidmap, client, workers=workers, pipeline=pipeline)
+
+
+class CheckpointJournal:
+    # journal of the CSV rows committed to Dgraph, one JSON line per chunk:
+    #   {"file": "donors.csv", "size": 1234, "rows": 200000, "xids": 51234, "done": false}
+    # rows is the number of rows of the file committed, xids the size of the xidmap at that point.
+    # A restarted load skips the files done and the rows committed of the others.
+    def __init__(self, path):
+        self.path = path
+        self.files = {}  # file -> last record
+        if os.path.isfile(path):
+            with open(path, "r") as journal:
+                for line in journal:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        # line truncated by a crash
+                        continue
+                    self.files[record["file"]] = record
+        self.journal = open(path, "a")
+
+    def last(self, filename, size):
+        # last record of the file, None if the file is new or has changed
+        record = self.files.get(filename)
+        if record is not None and record["size"] != size:
+            print(f"{filename} has changed since the checkpoint, loading it again")
+            return None
+        return record
+
+    def record(self, filename, size, rows, xids, done=False):
+        record = {"file": filename, "size": size, "rows": rows, "xids": xids, "done": done}
+        self.journal.write(json.dumps(record) + "\n")
+        self.journal.flush()
+        os.fsync(self.journal.fileno())
+        self.files[filename] = record
+
+    def close(self):
+        self.journal.close()
 
 
 def upload_schema(client, schema):
@@ -215,53 +460,256 @@ def upload_schema(client, schema):
 
 
 def upload_xid_schema(client, xid_predicate):
-    schema = f"""
-    {xid_predicate}: string @index(exact) @upsert .
-    """
-    upload_schema(client, schema)
+    upload_schema(client, xid_schema(xid_predicate))
     print("xid definition uploaded.")
 
 
-xidpredicate = "xid"
+class XidmapEndpointError(ValueError):
+    # the xidmap file was synced with another Dgraph cluster, its uids are not the ones of this cluster
+    pass
+
+
+def open_xidmap(client, xidpredicate, path=None, resync=False):
+    # without path, the xidmap is read from Dgraph in memory.
+    # with path, the xidmap is persisted in a SQLite file and updated by allocate_uid,
+    # it is read from Dgraph only when the file is new or on resync.
+    if path is None:
+        return readXidMapFromDgraph(client, xidpredicate)
+    xidmap = SqliteXidMap(path)
+    endpoint = getEndpoint()
+    known_endpoint = xidmap.get_meta("endpoint")
+    if known_endpoint is not None and known_endpoint != endpoint and not resync:
+        xidmap.close()
+        raise XidmapEndpointError(
+            f"xidmap {path} was synced with {known_endpoint}, not {endpoint}: "
+            "use --resync to read it again from this cluster, or a new --xidmap-db file"
+        )
+    if known_endpoint is None and xidmap.get_meta("source") == "csv_to_rdf" and not resync:
+        # uids assigned by csv_to_rdf.py --assign-uids and loaded with dgraph bulk
+        print(f"xidmap {path} exported by csv_to_rdf, used for {endpoint}")
+        xidmap.set_meta("endpoint", endpoint)
+        known_endpoint = endpoint
+    if known_endpoint is None or resync:
+        print(f"reading xidmap from {endpoint} to {path}")
+        xidmap.clear()
+        readXidMapFromDgraph(client, xidpredicate, xidmap)
+        xidmap.commit()
+        xidmap.set_meta("endpoint", endpoint)
+    print(f"xidmap {path}: {len(xidmap)} xids")
+    return xidmap
 
-gclient = getClient()
 
+def load_csv_file(f, template, client, xidmap, pipeline, chunksize=chunkSize, journal=None, xidpredicate="xid"):
+    # read the CSV file by chunks, transform them and load to dgraph
+    # with a journal, the rows already committed are skipped and each chunk is
+    # recorded once its mutations are done
+    filename = os.path.basename(f)
+    size = os.path.getsize(f)
+    rows = 0
+    if journal is not None:
+        record = journal.last(filename, size)
+        if record is not None and record["done"]:
+            print(f"{f} already loaded")
+            return xidmap
+        if record is not None:
+            rows = record["rows"]
+            if len(xidmap) < record["xids"]:
+                # the missing uids are found again by the upserts of allocate_uid
+                print(f"warning: the xidmap has {len(xidmap)} xids, {record['xids']} at the checkpoint")
+            print(f"resuming {f} at row {rows}")
+    # the journal counts data rows, not lines (a quoted value may span several lines):
+    # the committed rows are read again by the CSV reader and dropped
+    skipped = rows
+    reader = pd.read_csv(f, keep_default_na=True, dtype=str, chunksize=chunksize)
+    while True:
+        with metrics.timer("read"):
+            chunk = next(reader, None)
+        if chunk is None:
+            break
+        if skipped > 0:
+            dropped = min(skipped, len(chunk))
+            chunk = chunk.iloc[dropped:]
+            skipped -= dropped
+            if len(chunk) == 0:
+                continue
+        metrics.count("rows", len(chunk))
+        # LINENUMBER is the row index in the file, the reader numbers the rows across the chunks
+        #
+        # transform the dataframe and load to dgraph
+        #
+        xidmap = df_to_dgraph(chunk, template, client, xidpredicate, xidmap, vectorized=True, pipeline=pipeline)
+        rows += len(chunk)
+        if journal is not None:
+            pipeline.wait()
+            if pipeline.failed > 0:
+                raise RuntimeError(f"{pipeline.failed} mutations failed, {f} is committed up to row {rows - len(chunk)}")
+            if isinstance(xidmap, SqliteXidMap):
+                xidmap.commit()
+            journal.record(filename, size, rows, len(xidmap))
+    if journal is not None:
+        journal.record(filename, size, rows, len(xidmap), done=True)
+    return xidmap
 
-if len(sys.argv) == 3:
-    output_file = sys.argv[2]
-    schema_file = open(output_file, "r")
-    schema = schema_file.read()
-    schema_file.close()
-    print(f"schema ${output_file} loaded.")
-    upload_schema(gclient, schema)
-    print(f"schema ${output_file} uploaded.")
 
-upload_xid_schema(gclient, xidpredicate)
+def csv_files(csvdir):
+    # (CSV file, template) of the directory
+    files = []
+    for filename in os.listdir(csvdir):
+        f = os.path.join(csvdir, filename)
+        templatefilename = os.path.splitext(f)[0] + ".template"
+        if os.path.isfile(f) and filename.endswith(".csv") and os.path.isfile(templatefilename):
+            template_file = open(templatefilename, "r")
+            files.append((f, template_file.read()))
+            template_file.close()
+    return files
 
-# op = pydgraph.Operation(drop_op="DATA")
-# res = gclient.alter(op)
-# print("data deleted")
-# print(res)
 
-# Get XIDMAP
+def upload_directory_async(csvdir, xidmap, batcher, args):
+    # the asyncio loader, imported here as it imports this module
+    import asyncio
+    from async_loader import load_async
 
-xidmap = readXidMapFromDgraph(gclient, xidpredicate)
-# iterate over files in
-# that directory
-# get CSV file and associated template file
-# load to dgraph and update the xidmap
-for filename in os.listdir(csvdir):
-    f = os.path.join(csvdir, filename)
-    if os.path.isfile(f) and filename.endswith(".csv"):
-        print(f)
-        base = os.path.splitext(f)[0]
-        templatefilename = base + ".template"
-        if os.path.isfile(templatefilename):
-            template_file = open(templatefilename, "r")
-            template = template_file.read()
-            template_file.close()
-            df = pd.read_csv(f, keep_default_na=True, dtype=str)
-            #
-            # transform the dataframe and load to dgraph
-            #
-            xidmap = df_to_dgraph(df, template, gclient, xidpredicate, xidmap)
+    asyncio.run(
+        load_async(
+            csv_files(csvdir), xidmap, args.channels, args.concurrency, batcher, args.chunk_size, args.workers
+        )
+    )
+
+
+def upload_directory(gclient, args):
+    csvdir = args.directory
+
+    xidpredicate = "xid"
+
+    if args.schema_file is not None:
+        output_file = args.schema_file
+        schema_file = open(output_file, "r")
+        schema = schema_file.read()
+        schema_file.close()
+        print(f"schema ${output_file} loaded.")
+        upload_schema(gclient, schema)
+        print(f"schema ${output_file} uploaded.")
+
+    upload_xid_schema(gclient, xidpredicate)
+
+    # op = pydgraph.Operation(drop_op="DATA")
+    # res = gclient.alter(op)
+    # print("data deleted")
+    # print(res)
+
+    # Get XIDMAP
+
+    xidmap = open_xidmap(gclient, xidpredicate, args.xidmap_db, args.resync)
+    batcher = AdaptiveBatcher(args.batch_size, args.target_latency, maximum=max(maxBatchSize, args.batch_size))
+    if args.use_async:
+        try:
+            upload_directory_async(csvdir, xidmap, batcher, args)
+        finally:
+            if isinstance(xidmap, SqliteXidMap):
+                xidmap.close()
+        return
+    journal = CheckpointJournal(args.checkpoint) if args.checkpoint is not None else None
+    pipeline = MutationPipeline(gclient, workers=args.workers, batcher=batcher)
+    # iterate over files in
+    # that directory
+    # get CSV file and associated template file
+    # load to dgraph and update the xidmap
+    try:
+        for f, template in csv_files(csvdir):
+            print(f)
+            xidmap = load_csv_file(f, template, gclient, xidmap, pipeline, args.chunk_size, journal, xidpredicate)
+        pipeline.wait()
+    finally:
+        pipeline.close()
+        if journal is not None:
+            journal.close()
+        if isinstance(xidmap, SqliteXidMap):
+            xidmap.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Create RDF from the CSV files and their templates and mutate them to Dgraph.",
+        epilog="The script uses Dgraph grpc endpoint defined in DGRAPH_GRPC environment variable or localhost:9080. "
+        "If the grpc endpoint is a cloud instance, the scrip uses the key set in DGRAPH_ADMIN_KEY",
+    )
+    parser.add_argument(
+        "directory",
+        help="the directory containing the CSV files and their associated templates",
+    )
+    parser.add_argument("schema_file", nargs="?", help="DQL schema to upload before the data")
+    parser.add_argument(
+        "--xidmap-db", default=None,
+        help="SQLite file keeping the xid -> uid map between runs, instead of reading it from Dgraph at startup",
+    )
+    parser.add_argument(
+        "--resync", action="store_true",
+        help="with --xidmap-db, read the xid -> uid map from Dgraph again",
+    )
+    parser.add_argument(
+        "--workers", type=int, default=1,
+        help="number of mutations sent in parallel, the RDF are partitioned by subject (default 1). "
+        "With --async, number of processes rendering the templates",
+    )
+    parser.add_argument(
+        "--async", dest="use_async", action="store_true",
+        help="load with the asyncio pipeline and the grpc.aio client",
+    )
+    parser.add_argument(
+        "--concurrency", type=int, default=64,
+        help="with --async, number of mutations in flight, the RDF are partitioned by subject (default 64)",
+    )
+    parser.add_argument(
+        "--batch-size", type=parse_size, default=batchSize,
+        help="bytes of RDF sent by the first mutations, e.g. 512K or 4M (default 1M)",
+    )
+    parser.add_argument(
+        "--target-latency", type=int, default=targetLatency,
+        help=f"ms, the mutations grow while they take less time and shrink when slower or aborted, 0 keeps --batch-size (default {targetLatency})",
+    )
+    parser.add_argument(
+        "--chunk-size", type=int, default=chunkSize,
+        help=f"number of CSV lines read and loaded at once (default {chunkSize})",
+    )
+    parser.add_argument(
+        "--checkpoint", default=None,
+        help="journal of the committed rows: a load restarted with the same journal skips them",
+    )
+    parser.add_argument(
+        "--channels", type=int, default=None,
+        help="number of gRPC channels, used round-robin over the comma separated endpoints of DGRAPH_GRPC (default one per endpoint)",
+    )
+    parser.add_argument(
+        "--progress", type=float, default=10,
+        help="seconds between two progress lines, 0 to disable (default 10)",
+    )
+    parser.add_argument(
+        "--metrics", default=None,
+        help="JSON file to write the counters and the timings of each stage to",
+    )
+    args = parser.parse_args()
+    if args.use_async and args.checkpoint is not None:
+        parser.error("--checkpoint is not supported with --async")
+
+    progress = ProgressReporter(metrics, args.progress) if args.progress > 0 else None
+    # one pool of channels for the whole load, closed at exit
+    gclient = ClientPool(args.channels)
+    try:
+        upload_directory(gclient, args)
+    except XidmapEndpointError as e:
+        parser.error(str(e))
+    finally:
+        gclient.close()
+        if progress is not None:
+            progress.close()
+        if args.metrics is not None:
+            metrics.write_summary(args.metrics)
+    # mutations given up (aborted or failed after the retries): the load is partial
+    failed = metrics.counters["failed"]
+    if failed > 0:
+        print(f"{failed} mutations failed, the data is partially loaded", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
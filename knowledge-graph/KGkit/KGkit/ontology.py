@@ -1,7 +1,10 @@
 from dataclasses import dataclass, field
 from graphql import parse,build_schema, GraphQLObjectType,GraphQLField, GraphQLString,GraphQLSchema, print_schema
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Iterator
+from concurrent.futures import ThreadPoolExecutor
 import json
+import random
+import time
 import pydgraph
 from .types import KGClass, KGSchema
 
@@ -27,10 +30,42 @@ class Entity:
     description: Optional[str] = None
     related_to: Optional['Entity'] = None
 
-def query_entities(client:pydgraph.DgraphClient,) -> List[Entity]:
-    query = """
+# Paginated queries
+# the nodes of the "list" block are read by pages of page_size with first/after uid cursors (as readXidMapFromDgraph)
+# in one read-only transaction, so memory is bounded by a page whatever the size of the graph.
+# With prefetch, the next page is queried by a background thread while the current one is consumed.
+pageSize = 1000  # nodes per page of the paginated queries
+
+def paginate(client:pydgraph.DgraphClient, statement: str, page_size: int = pageSize, prefetch: bool = False) -> Iterator[Dict[str, Any]]:
+    # statement has a $pagination placeholder in the arguments of its list block, whose nodes return their uid
+    txn = client.txn(read_only=True)
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+
+    def fetch(after: Optional[str]) -> List[Dict[str, Any]]:
+        pagination = f"first: {page_size}" + (f", after: {after}" if after is not None else "")
+        res = txn.query(statement.replace("$pagination", pagination))
+        return json.loads(res.json)['list']
+
+    try:
+        page = fetch(None)
+        while True:
+            if len(page) < page_size:
+                yield from page
+                break
+            after = page[-1]['uid']
+            next_page = executor.submit(fetch, after) if executor is not None else None
+            yield from page
+            page = next_page.result() if next_page is not None else fetch(after)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+        txn.discard()
+
+def iter_entities(client:pydgraph.DgraphClient, page_size: int = pageSize, prefetch: bool = False) -> Iterator[Entity]:
+    statement = """
     {
-      list(func: has(is_a)) @normalize {
+      list(func: has(is_a), $pagination) @normalize {
+        uid: uid
         id: xid
         label: <rdfs:label>
         description: <rdfs:comment>
@@ -38,10 +73,12 @@ def query_entities(client:pydgraph.DgraphClient,) -> List[Entity]:
       }
     }
     """
-    txn = client.txn(readOnly=True)
-    res = txn.query(query)
-    entities = json.loads(res.json)['list']
-    return [Entity(**entity) for entity in entities]
+    for entity in paginate(client, statement, page_size, prefetch):
+        entity.pop('uid')
+        yield Entity(**entity)
+
+def query_entities(client:pydgraph.DgraphClient,) -> List[Entity]:
+    return list(iter_entities(client))
 
 @dataclass
 class RelatedEntity:
@@ -75,11 +112,12 @@ class Relationship:
     label: str = ""
     description: str = ""
 
-def get_kg_schemas(client:pydgraph.DgraphClient,names: Optional[List[str]]) -> List[KGSchema]:
+def iter_kg_schemas(client:pydgraph.DgraphClient, names: Optional[List[str]] = None, page_size: int = pageSize, prefetch: bool = False) -> Iterator[KGSchema]:
     func = 'has(KGSchema.label)' if names is None else f'eq(KGSchema.label, {json.dumps(names)})'
     statement = f"""
-    query GetKGSchema() {{
-      list(func: {func}) {{
+    {{
+      list(func: {func}, $pagination) {{
+        uid
         label:KGSchema.label
         description:KGSchema.description
         classes:KGSchema.classes {{
@@ -91,10 +129,12 @@ def get_kg_schemas(client:pydgraph.DgraphClient,names: Optional[List[str]]) -> L
       }}
     }}
     """
-    txn = client.txn(read_only=True)
-    res = txn.query(statement)
-    data = json.loads(res.json)
-    return [KGSchema(**schema) for schema in data['list']]
+    for schema in paginate(client, statement, page_size, prefetch):
+        schema.pop('uid')
+        yield KGSchema(**schema)
+
+def get_kg_schemas(client:pydgraph.DgraphClient,names: Optional[List[str]]) -> List[KGSchema]:
+    return list(iter_kg_schemas(client, names))
 
 def delete_kg_class(client:pydgraph.DgraphClient,namespace: str, label: str) -> Optional[Dict[str, str]]:
     id = f"{namespace}/{label}"
@@ -118,21 +158,23 @@ def delete_kg_class(client:pydgraph.DgraphClient,namespace: str, label: str) ->
     res = txn.mutate(mutation=mutation)
     return res.uids
 
-def get_kg_classes(client:pydgraph.DgraphClient) -> List[KGClass]:
+def iter_kg_classes(client:pydgraph.DgraphClient, page_size: int = pageSize, prefetch: bool = False) -> Iterator[KGClass]:
     statement = """
     {
-      list(func: has(KGClass.label)) {
-        KGClass.id
-        KGClass.role
-        KGClass.label
-        KGClass.description
+      list(func: has(KGClass.label), $pagination) {
+        uid
+        id:KGClass.id
+        role:KGClass.role
+        label:KGClass.label
+        description:KGClass.description
       }
     }
     """
-    txn = client.txn()
-    res = txn.query(statement)
-    data = json.loads(res.json)
-    return [KGClass(**kg_class) for kg_class in data['list']]
+    for kg_class in paginate(client, statement, page_size, prefetch):
+        yield KGClass(**kg_class)
+
+def get_kg_classes(client:pydgraph.DgraphClient) -> List[KGClass]:
+    return list(iter_kg_classes(client))
 
 @dataclass
 class AddKGClassInput:
@@ -161,96 +203,152 @@ def add_kg_class(client:pydgraph.DgraphClient,namespace: str, classes: List[AddK
         uid(s) <KGSchema.classes> uid(c{i}) .
         """
     query_statement += "}"
-    mutation = pydgraph.Mutation(set_nquads=nquads)
-    txn = client.txn()
-    res = txn.mutate(mutation=mutation)
+    # the query must be sent with the mutation for uid(s) and uid(cN) to resolve to the existing nodes,
+    # and committed: a mutation left in an open transaction is discarded
+    res = upsert(client, query_statement, nquads)
     return res.uids
 
 
-def add_related_entities(client:pydgraph.DgraphClient,namespace: str, entities: List[RelatedEntity]) -> str:
-    for entity in entities:
-        add_related_entity(client, namespace, entity)
+# Batched upserts
+# the entities are written by batches of batch_size per request: one numbered var block per looked up node
+# (as add_kg_class) and the set mutation of the whole batch, committed at once.
+# With concurrency > 1 the batches are sent by that many threads; the entities are deduplicated by xid first
+# so two concurrent batches never create the same node.
+batchSize = 500  # entities per upsert request
+upsertTries = 3
+
+def literal(value) -> str:
+    # quoted and escaped string for DQL and N-Quads
+    return json.dumps(str(value), ensure_ascii=False)
+
+class UpsertBlock:
+    # query and set nquads of one upsert request
+    def __init__(self):
+        self.vars = {}  # (predicate, value) -> var name
+        self.blanks = 0
+        self.query = []
+        self.nquads = []
+
+    def var(self, prefix: str, predicate: str, value: str) -> str:
+        # uid(var) of the nodes with predicate = value, a single var block per (predicate, value)
+        key = (predicate, value)
+        if key not in self.vars:
+            name = f"{prefix}{len(self.vars)}"
+            self.vars[key] = name
+            self.query.append(f"{name} as var(func: eq({predicate}, {literal(value)}))")
+        return f"uid({self.vars[key]})"
+
+    def blank(self, prefix: str) -> str:
+        self.blanks += 1
+        return f"<_:{prefix}{self.blanks}>"
+
+    def add(self, subject: str, predicate: str, obj: str):
+        self.nquads.append(f"{subject} <{predicate}> {obj} .")
+
+    def statement(self) -> str:
+        return "{\n" + "\n".join(self.query) + "\n}"
+
+def upsert(client:pydgraph.DgraphClient, query: str, nquads: str):
+    # send the query and the mutation in one request, retried after a random wait when aborted by a concurrent transaction
+    for i in range(upsertTries):
+        txn = client.txn()
+        try:
+            mutation = txn.create_mutation(set_nquads=nquads)
+            request = txn.create_request(query=query, mutations=[mutation], commit_now=True)
+            return txn.do_request(request)
+        except pydgraph.errors.AbortedError:
+            if i == upsertTries - 1:
+                raise
+            time.sleep(random.uniform(0, 0.1 * 2**i))
+        finally:
+            txn.discard()
+
+def upsert_batches(client:pydgraph.DgraphClient, items: List[Any], build, batch_size: int = batchSize, concurrency: int = 1) -> list:
+    # build(block, item) adds the var blocks and nquads of an item, one upsert per batch of items
+    def send(batch):
+        block = UpsertBlock()
+        for item in batch:
+            build(block, item)
+        return upsert(client, block.statement(), "\n".join(block.nquads))
+
+    batches = [items[i:i + batch_size] for i in range(0, len(items), batch_size)]
+    if concurrency <= 1 or len(batches) <= 1:
+        return [send(batch) for batch in batches]
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        return list(executor.map(send, batches))
+
+def entity_xid(entity: Entity) -> str:
+    return f"{entity.is_a}#{entity.label}"
+
+def relational_entity_xid(entity: RelationalEntity) -> str:
+    return f"{entity.subject.is_a}:{entity.subject.label}-{entity.object.is_a}:{entity.object.label}-{entity.is_a}:{entity.label}"
+
+def unique_by(items: List[Any], key) -> List[Any]:
+    # last item of each key, in the order of the first one
+    return list({key(item): item for item in items}.values())
+
+def add_related_entities(client:pydgraph.DgraphClient,namespace: str, entities: List[RelatedEntity], batch_size: int = batchSize, concurrency: int = 1) -> str:
+    upsert_batches(client, entities, build_related_entity, batch_size, concurrency)
     return "Success"
 
 def add_related_entity(client:pydgraph.DgraphClient,namespace: str, entity: RelatedEntity) -> str:
-    xid = f"{entity.subject.is_a}:{entity.subject.label}"
-    query = f"""
-    {{
-      source as var(func: eq(xid, "{xid}"))
-    }}
-    """
-    nquads = f"""
-    <_:e> <entity.type> "{entity.is_a}" .
-    <_:e> <subject> uid(source) .
-    <_:e> <rdfs:comment> "{entity.description}" .
-    """
-    mutation = pydgraph.Mutation(set_nquads=nquads)
+    return upsert_batches(client, [entity], build_related_entity)[0].json
 
-    txn = client.txn()
-    res = txn.mutate(mutation=mutation)
-    return res.json
+def build_related_entity(block: UpsertBlock, entity: RelatedEntity):
+    xid = f"{entity.subject.is_a}:{entity.subject.label}"
+    source = block.var("s", "xid", xid)
+    node = block.blank("e")
+    block.add(node, "entity.type", literal(entity.is_a))
+    block.add(node, "subject", source)
+    block.add(node, "rdfs:comment", literal(entity.description))
 
-def add_relational_entities(client:pydgraph.DgraphClient,namespace: str, entities: List[RelationalEntity]) -> str:
-    for entity in entities:
-        add_relational_entity(client, namespace, entity)
+def add_relational_entities(client:pydgraph.DgraphClient,namespace: str, entities: List[RelationalEntity], batch_size: int = batchSize, concurrency: int = 1) -> str:
+    entities = unique_by(entities, relational_entity_xid)
+    upsert_batches(client, entities, build_relational_entity, batch_size, concurrency)
     return "Success"
 
 def add_relational_entity(client:pydgraph.DgraphClient,namespace: str, entity: RelationalEntity) -> str:
-    xid = f"{entity.subject.is_a}:{entity.subject.label}-{entity.object.is_a}:{entity.object.label}-{entity.is_a}:{entity.label}"
-    source_xid = f"{entity.subject.is_a}:{entity.subject.label}"
-    target_xid = f"{entity.object.is_a}:{entity.object.label}"
-    query = f"""
-    {{
-      xid as var(func: eq(xid, "{xid}"))
-      source as var(func: eq(xid, "{source_xid}"))
-      target as var(func: eq(xid, "{target_xid}"))
-    }}
-    """
-    nquads = f"""
-    uid(xid) <entity.type> "{entity.is_a}" .
-    uid(xid) <xid> "{xid}" .
-    uid(xid) <subject> uid(source) .
-    uid(xid) <object> uid(target) .
-    uid(xid) <rdfs:label> "{entity.label}" .
-    uid(xid) <rdfs:comment> "{entity.description}" .
-    """
-    mutation = pydgraph.Mutation(set_nquads=nquads)
-    txn = client.txn()
-    res = txn.mutate(mutation=mutation)
-    return res.json
+    return upsert_batches(client, [entity], build_relational_entity)[0].json
 
-def add_entities(client:pydgraph.DgraphClient,entities: List[Entity], docid: Optional[str]) -> str:
-    for entity in entities:
-        add_entity(client,entity, docid)
+def build_relational_entity(block: UpsertBlock, entity: RelationalEntity):
+    xid = relational_entity_xid(entity)
+    node = block.var("x", "xid", xid)
+    source = block.var("s", "xid", f"{entity.subject.is_a}:{entity.subject.label}")
+    target = block.var("t", "xid", f"{entity.object.is_a}:{entity.object.label}")
+    block.add(node, "entity.type", literal(entity.is_a))
+    block.add(node, "xid", literal(xid))
+    block.add(node, "subject", source)
+    block.add(node, "object", target)
+    block.add(node, "rdfs:label", literal(entity.label))
+    block.add(node, "rdfs:comment", literal(entity.description))
+
+def add_entities(client:pydgraph.DgraphClient,entities: List[Entity], docid: Optional[str], batch_size: int = batchSize, concurrency: int = 1) -> str:
+    if docid is not None:
+        # created once, before the batches looking it up
+        add_document(client, docid)
+    entities = unique_by(entities, entity_xid)
+    upsert_batches(client, entities, lambda block, entity: build_entity(block, entity, docid), batch_size, concurrency)
     return "Success"
 
 def add_entity(client:pydgraph.DgraphClient,entity: Entity, docid: Optional[str]) -> str:
-    xid = f"{entity.is_a}#{entity.label}"
-    d_val = ""
-    d_rel = ""
     if docid is not None:
-        d_val = f'd as var(func: eq(KGDocument.id, "{docid}"))'
-        d_rel = f"""
-        uid(v) <found_in> uid(d) .
-        uid(d) <KGDocument.id> "{docid}" .
-        uid(d) <dgraph.type> "KGDocument" .
-        """
-    query = f"""
-    {{
-      v as var(func: eq(xid, "{xid}"))
-      c as var(func: eq(KGClass.id, "{entity.is_a}"))
-      {d_val}
-    }}
-    """
-    nquads = f"""
-    uid(v) <xid> "{xid}" .
-    uid(v) <rdfs:label> "{entity.label}" .
-    uid(v) <is_a> uid(c) .
-    {d_rel}
-    """
+        add_document(client, docid)
+    return upsert_batches(client, [entity], lambda block, entity: build_entity(block, entity, docid))[0].json
+
+def add_document(client:pydgraph.DgraphClient, docid: str):
+    block = UpsertBlock()
+    document = block.var("d", "KGDocument.id", docid)
+    block.add(document, "KGDocument.id", literal(docid))
+    block.add(document, "dgraph.type", literal("KGDocument"))
+    return upsert(client, block.statement(), "\n".join(block.nquads))
+
+def build_entity(block: UpsertBlock, entity: Entity, docid: Optional[str]):
+    xid = entity_xid(entity)
+    node = block.var("v", "xid", xid)
+    block.add(node, "xid", literal(xid))
+    block.add(node, "rdfs:label", literal(entity.label))
+    block.add(node, "is_a", block.var("c", "KGClass.id", entity.is_a))
+    if docid is not None:
+        block.add(node, "found_in", block.var("d", "KGDocument.id", docid))
     if entity.description:
-        nquads += f'uid(v) <rdfs:comment> "{entity.description}" .'
-    mutation = pydgraph.Mutation(set_nquads=nquads)
-    txn = client.txn()
-    res = txn.mutate(mutation=mutation)
-    return res.jsons
\ No newline at end of file
+        block.add(node, "rdfs:comment", literal(entity.description))
@@ -6,14 +6,19 @@ import grpc
 import re
 import json
 import fitz  # PyMuPDF
+from concurrent.futures import ThreadPoolExecutor
 from mistralai import Mistral
 from graphql import GraphQLSchema,build_schema,print_schema,GraphQLObjectType,GraphQLField,GraphQLList
 from typing import Optional, List, Any, Dict
-from .rdf_lib import df_to_rdf_map
-from .upload_csv import rdf_map_to_dgraph
-from .types import DataSource, TableEntityMapping, TableMapping, ExtractedData
+import pandas as pd
+from .rdf_lib import DATETIME_FORMATS, df_to_rdf_map
+from .upload_csv import SharedXidMap, rdf_map_to_dgraph
+from .xidmap import xid_schema
+from .types import ColumnProfile, DataSource, TableEntityMapping, TableMapping, ExtractedData
 
 DESC_PREFIX = "KG:"
+profileSampleSize = 10000  # rows sampled to detect the type of the columns
+categoricalRatio = 0.05  # text columns with fewer distinct values than this ratio of their values are categories
 class DataModel:
     def __init__(self):
         self.types: Dict[str, ObjectType] = {}
@@ -135,9 +140,7 @@ class KG(object):
         return self.dgraph_client.alter(op)
 
     def __init_schema__(self):
-        self.__add_types_and_predicates__(schema='''
-        <xid>: string @index(hash) .
-        ''')
+        self.__add_types_and_predicates__(schema=xid_schema())
     def __init_GraphQL_schema__(self):
         self.GraphQL_schema()
 
@@ -233,38 +236,65 @@ class KG(object):
         self.__graphql_schema__ = build_schema(schema,assume_valid=True)
     def load_tabular_data(self,
              sources: List[DataSource],
-             mutate: Optional[bool] = True
+             mutate: Optional[bool] = True,
+             parallel: Optional[int] = None,
+             sample_size: int = profileSampleSize
              ) -> List[TableMapping]:
-        table_mappings = []
-        for source in sources:
-            table_mappings.append(self.__load_entity( source, mutate))
+        # sample_size: rows sampled to detect the column types (see profile_columns)
+        # parallel: number of sources rendered and mutated concurrently.
+        # The mappings are computed and the schema altered for all the sources first,
+        # then the sources are loaded with a shared xid map so relationships between them resolve to the same nodes
+        xidmap = SharedXidMap()
+        if parallel is None or parallel <= 1:
+            return [self.__load_entity(source, mutate, xidmap, sample_size) for source in sources]
+        table_mappings = [self.__map_entity(source, mutate, sample_size) for source in sources]
+        if mutate:
+            with ThreadPoolExecutor(max_workers=parallel) as executor:
+                futures = [
+                    executor.submit(self.__mutate_entity, source, mapping, xidmap)
+                    for source, mapping in zip(sources, table_mappings)
+                    if mapping.template is not None
+                ]
+                for future in futures:
+                    future.result()
         return table_mappings
 
-    def __load_entity(self, source: DataSource, mutate: bool = False) -> TableMapping:
+    def __load_entity(self, source: DataSource, mutate: bool = False, xidmap=None, sample_size: int = profileSampleSize) -> TableMapping:
+        mapping = self.__map_entity(source, mutate, sample_size)
+        if mutate and mapping.template is not None:
+            self.__mutate_entity(source, mapping, xidmap)
+        return mapping
+
+    def __mutate_entity(self, source: DataSource, mapping: TableMapping, xidmap=None):
+        rdfmap = df_to_rdf_map(text_frame(source.data_frame), mapping.template)
+        rdf_map_to_dgraph(rdfmap, xidmap if xidmap is not None else {}, self.dgraph_client)
+
+    def __map_entity(self, source: DataSource, alter: bool = False, sample_size: int = profileSampleSize) -> TableMapping:
+        # heuristics, template and schema of the source, the schema is altered if alter
         entities = extract_entities_from_column_names(source)
         entity_name = entities[0]
         # Assuming only one main entity per data source for now
         # TODO: Handle multiple entities in one data source
-        df = source.data_frame
+        # profiled from the strings rendered by __mutate_entity
+        df = text_frame(source.data_frame)
         mapping = TableMapping()
         entity_mapping = TableEntityMapping(entity_name)
-        entity_mapping.id_field = guess_id_field(df)
+        entity_mapping.profiles = profile_columns(df, sample_size)
+        entity_mapping.id_field = guess_id_field(df, entity_mapping.profiles)
         entity_mapping.columns = df.columns.to_list()
         entity_mapping.properties = guess_properties(entity_name, columns=df.columns.to_list())
 
         entity_mapping.relationships = guess_relationships(entity_name, df.columns.to_list())
-        if any(entity_mapping.properties):
+        if any(entity_mapping.properties) and entity_mapping.id_field is not None:
             template, test = generateTemplate(entity_name, entity_mapping)
             print(test)
             mapping.schema = generateSchema(entity_name, entity_mapping)
             mapping.template = template
-            if mutate:
+            if alter:
                 try:
                     self.__add_types_and_predicates__(mapping.schema)
                 except Exception as e:
                     mapping.error = str(e)
-                rdfmap = df_to_rdf_map(df, template)
-                rdf_map_to_dgraph(rdfmap, {}, self.dgraph_client)
 
         else:
             mapping.error = "No unique columns found"
@@ -475,15 +505,85 @@ def extract_entities_from_column_names(source: DataSource) -> List[str]:
         entities.append("Thing")
     return list(entities)
 
+# Values of a data frame as the strings rendered in the RDF, missing values kept as NaN
+# the columns are profiled and rendered from the same text: the row rendering goes through df.to_numpy(),
+# which would write the int columns of an all-numeric frame as floats ("10.0") and the dates as timestamps
+def text_frame(df):
+    return df.apply(lambda column: column.astype(str).where(column.notna()))
+
+# Profile of the columns
+# uniqueness, distinct values and null ratio are computed on the whole column from 64-bit hashes of the values,
+# the type is detected on a random sample of sample_size rows, then checked on the whole column
+re_int = r"[+-]?(0|[1-9]\d{0,17})"  # no leading 0 (codes, zip), fits in Dgraph int (int64)
+re_float = r"[+-]?((0|[1-9]\d*)(\.\d*)?|\.\d+)([eE][+-]?\d+)?"
+def profile_columns(df, sample_size: int = profileSampleSize, seed: int = 0) -> Dict[str, ColumnProfile]:
+    sample = df.sample(sample_size, random_state=seed) if len(df) > sample_size else df
+    profiles = {}
+    for column in df.columns:
+        values = df[column].dropna()
+        hashes = pd.util.hash_pandas_object(values, index=False)
+        profile = ColumnProfile(column)
+        profile.distinct = int(hashes.nunique())
+        profile.count = len(values)
+        profile.unique = profile.distinct == len(values)
+        profile.null_ratio = 1 - len(values) / len(df) if len(df) > 0 else 0.0
+        sampled = sample[column].dropna()
+        profile.sample_size = len(sampled)
+        profile.dtype, profile.datetime_format = guess_type(sampled)
+        if profile.dtype != "string" and len(sampled) < len(values):
+            # a value out of the sample may not convert, the typed predicate would reject the mutation
+            profile.dtype, profile.datetime_format = guess_type(values)
+        if profile.dtype == "string" and len(sampled) > 0:
+            profile.words = bool(sampled.astype(str).str.contains(r"\S\s+\S").mean() > 0.5)
+        profiles[column] = profile
+    return profiles
+
+def guess_type(values: pd.Series):
+    # (dtype, datetime format) of the non null values of a column
+    if len(values) == 0 or pd.api.types.is_bool_dtype(values):
+        return "string", None
+    if pd.api.types.is_integer_dtype(values):
+        return "int", None
+    if pd.api.types.is_float_dtype(values):
+        return "float", None
+    text = values.astype(str)
+    if text.str.fullmatch(re_int).all():
+        return "int", None
+    if text.str.fullmatch(re_float).all():
+        return "float", None
+    for format, pattern in DATETIME_FORMATS.items():
+        if text.str.fullmatch(pattern).all() and pd.to_datetime(text, format=format, errors="coerce").notna().all():
+            return "datetime", format
+    return "string", None
+
+# Index of a predicate from the profile of its column
+# hash for the ids and other high cardinality text, exact for categories (sorting, inequalities),
+# term for text of several words (allofterms, anyofterms), int, float and hour/day range indexes
+def guess_index(profile: Optional[ColumnProfile]) -> Optional[str]:
+    if profile is None or profile.distinct == 0:
+        return None
+    if profile.dtype in ("int", "float"):
+        return profile.dtype
+    if profile.dtype == "datetime":
+        return "hour" if "%H" in profile.datetime_format else "day"
+    if profile.unique and not profile.words:
+        return "hash"
+    if profile.distinct <= categoricalRatio * profile.count:
+        return "exact"
+    if profile.words:
+        return "term"
+    return "hash"
+
 # Heuristic to get ID field
-# get first field that seems unique
-def guess_id_field(df):
-    df_small = df.head(100)
-    unique_columns = []
-    for column in df_small.columns:
-        if df_small[column].dropna().is_unique:
-            unique_columns.append(column)
-    return unique_columns[0]
+# get first field that is unique, without missing value if possible
+def guess_id_field(df, profiles: Optional[Dict[str, ColumnProfile]] = None):
+    if profiles is None:
+        profiles = profile_columns(df)
+    unique_columns = [column for column in df.columns if profiles[column].unique and profiles[column].distinct > 0]
+    for column in unique_columns:
+        if profiles[column].null_ratio == 0:
+            return column
+    return unique_columns[0] if unique_columns else None
 
 # Heuristic to get properties for the entity_name
 # Get all columns prefix with <entity_name>.
@@ -527,26 +627,22 @@ def generateTemplate(entity, mapping: TableEntityMapping):
     template = "<{}> <dgraph.type> \"{}\" .\n".format(uid,entity)
     template +=  "<{}> <xid> \"{}\" .\n".format(uid,uid)
 
-    geo_loc = {}
+    geo_loc = guess_geo_fields(columns, mapping.profiles)
+    geo_columns = [column for fields in geo_loc.values() for column in fields.values()]
     for column in columns:
-        if (prefix_lat := guess_latitude(column)) is not None:
-            if prefix_lat not in geo_loc:
-                geo_loc[prefix_lat] = {}
-            geo_loc[prefix_lat]['lat'] = column
-        elif (prefix_long := guess_longitude(column)) is not None:
-            if prefix_long not in geo_loc:
-                geo_loc[prefix_long] = {}
-            geo_loc[prefix_long]['long'] = column
+        if column in geo_columns:
+            continue
+        predicate = column if column.startswith(entity+".") else entity+"."+column
+        profile = mapping.profiles.get(column)
+        if profile is not None and profile.dtype == "datetime":
+            # converted to the Dgraph datetime format
+            template += "<{}> <{}> =datetime([{}],{}) .\n".format(uid,predicate,column,profile.datetime_format)
         else:
-            predicate = column if column.startswith(entity+".") else entity+"."+column
             template += "<{}> <{}> \"[{}]\" .\n".format(uid,predicate,column)
     # check geo_loc fields
     print(geo_loc)
     for prefix, fields in geo_loc.items():
-        lat_field = fields.get('lat')
-        long_field = fields.get('long')
-        if (lat_field is not None) and (long_field is not None):
-            template += "<{}> <{}.{}> \"{{'type':'Point','coordinates':[[{}],[{}]]}}\"^^<geo:geojson> .\n".format(uid,entity,prefix,lat_field,long_field)
+        template += "<{}> <{}.{}> =geoloc([{}],[{}]) .\n".format(uid,entity,prefix,fields['lat'],fields['long'])
     for column in mapping.relationships:
         target = column.split(".")[0]
         predicate = f"{entity}.{target}"
@@ -554,14 +650,26 @@ def generateTemplate(entity, mapping: TableEntityMapping):
         template += "<{}> <{}> {} .\n".format(uid,predicate,target_blank_uid)
         template += "{} <dgraph.type> \"{}\" .\n".format(target_blank_uid,target)
     return template, template
-def generateSchema(entity, mapping: TableEntityMapping) -> str:
+def generateSchema(entity, mapping: TableEntityMapping, with_indexes: bool = True) -> str:
     types = ''
     predicates = ''
     types += "type {0} {{\n".format(entity)
+    geo_loc = guess_geo_fields(mapping.properties, mapping.profiles)
+    geo_columns = [column for fields in geo_loc.values() for column in fields.values()]
     for column in mapping.properties:
+        if column in geo_columns:
+            continue
         predicate = column if column.startswith(entity+".") else entity+"."+column
+        profile = mapping.profiles.get(column)
+        index = guess_index(profile) if with_indexes else None
+        types += "  <{0}>\n".format(predicate)
+        predicates += "<{0}>: {1}{2} .\n".format(
+            predicate, profile.dtype if profile is not None else "string", " @index({})".format(index) if index else ""
+        )
+    for prefix in geo_loc:
+        predicate = f"{entity}.{prefix}"
         types += "  <{0}>\n".format(predicate)
-        predicates += "<{0}>: string .\n".format(predicate)
+        predicates += "<{0}>: geo{1} .\n".format(predicate, " @index(geo)" if with_indexes else "")
     for column in mapping.relationships:
         target = column.split(".")[0]
         predicate = f"{entity}.{target}"
@@ -569,6 +677,19 @@ def generateSchema(entity, mapping: TableEntityMapping) -> str:
         predicates += "<{0}>: uid @reverse .\n".format(predicate)
     types += "}\n"
     return predicates + types
+# latitude and longitude columns with the same prefix: {prefix: {'lat': column, 'long': column}}
+# the columns must be numbers when they are profiled
+def guess_geo_fields(columns: list[str], profiles: Optional[Dict[str, ColumnProfile]] = None):
+    profiles = profiles or {}
+    geo_loc = {}
+    for column in columns:
+        if column in profiles and profiles[column].dtype not in ("int", "float"):
+            continue
+        if (prefix_lat := guess_latitude(column)) is not None:
+            geo_loc.setdefault(prefix_lat, {})['lat'] = column
+        elif (prefix_long := guess_longitude(column)) is not None:
+            geo_loc.setdefault(prefix_long, {})['long'] = column
+    return {prefix: fields for prefix, fields in geo_loc.items() if 'lat' in fields and 'long' in fields}
 def guess_latitude(column:str) -> str:
     for postfix in ['latitude','lat']:
         if column.lower().endswith(postfix):
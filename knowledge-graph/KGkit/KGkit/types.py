@@ -8,11 +8,23 @@ class DataSource:
         self.name = name
         self.data_frame = data
 @dataclass
+class ColumnProfile:
+    name: str
+    dtype: str = "string"  # string, int, float or datetime
+    datetime_format: Optional[str] = None  # strptime format of a datetime column
+    unique: bool = False  # no duplicated non null value in the column
+    distinct: int = 0  # number of distinct non null values
+    count: int = 0  # number of non null values
+    words: bool = False  # text of several words (most sampled values contain a space)
+    null_ratio: float = 0.0
+    sample_size: int = 0  # rows used for the type detection
+@dataclass
 class TableEntityMapping:
     entity: str
     id_field: str = None
     properties: List[str] = field(default_factory=lambda: [])
     relationships: List[str] = field(default_factory=lambda: [])
+    profiles: Dict[str, ColumnProfile] = field(default_factory=lambda: {})
 @dataclass
 class TableMapping:
     entity_mappings : List[TableEntityMapping] = field(default_factory=lambda: [])
@@ -1,7 +1,12 @@
 import json
+import random
 import re
+import threading
+import time
+from contextlib import nullcontext
 import pydgraph
 from .rdf_lib import df_to_rdf_map, rdf_map_to_rdf
+from .xidmap import CompactXidMap, xid_schema
 
 
 
@@ -10,9 +15,9 @@ from .rdf_lib import df_to_rdf_map, rdf_map_to_rdf
 
 def readXidMapFromDgraph(client, predicate="xid"):
     # xid from dgraph by batch (pagination)
-    # return a map of xid -> uid
+    # return a map of xid -> uid, kept compact in memory (CompactXidMap)
 
-    xidmap = dict({})
+    xidmap = CompactXidMap()
     txn = client.txn(read_only=True)
     batch = 10000
     after = ""
@@ -35,8 +40,9 @@ def readXidMapFromDgraph(client, predicate="xid"):
             )
             res = txn.query(query)
             data = json.loads(res.json)
-            for e in data["xidmap"]:
-                xidmap["<" + e[predicate] + ">"] = "<" + e["uid"] + ">"
+            xidmap.update(
+                {"<" + e[predicate] + ">": "<" + e["uid"] + ">" for e in data["xidmap"]}
+            )
             if len(data["xidmap"]) < batch:
                 break
             after = ",after:" + data["xidmap"][-1]["uid"]
@@ -45,8 +51,20 @@ def readXidMapFromDgraph(client, predicate="xid"):
     return xidmap
 
 
+class SharedXidMap(dict):
+    # xid -> uid map shared by the sources loaded concurrently (KG.load_tabular_data):
+    # split_mutate holds the lock only to look up and update the map, the upserts and mutations run outside it.
+    # Two sources allocating the same xid conflict on the @upsert index of xid (xid_schema),
+    # the aborted upsert is retried and reads the uid of the other, so a xid gets a single uid.
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.lock = threading.Lock()
+
+
 re_blank_bracket = re.compile(r"(<_:\S+>)")
 re_blank_node = re.compile(r"<(_:\S+)>")  # used for findall
+abortTries = 3  # tries of an upsert or a mutation aborted by a concurrent transaction
+abortBackoff = 0.1  # seconds, maximum random wait before the first retry, doubled at each try
 
 
 def allocate_uid(client, body, xidmap):
@@ -65,26 +83,35 @@ def allocate_uid(client, body, xidmap):
         query_list.append("}")
         query = "\n".join(query_list)
         nquads = "\n".join(nquad_list)
-        txn = client.txn()
-        try:
-            mutation = txn.create_mutation(set_nquads=nquads)
-            request = txn.create_request(query=query, mutations=[mutation])
-            res = txn.do_request(request)
-            txn.commit()
-            #  new uid for xid are in res.uids
-            #  existing uid for xid are res.json payload
-            for n in res.uids:
-                idx = n[n.index("(") + 1 : n.index(")")]
-                xidmap["<" + blank_map[idx] + ">"] = "<" + res.uids[n] + ">"
-
-            queries = json.loads(res.json)
-            for idx in queries:
-                if len(queries[idx]) > 0:
-                    xidmap["<" + blank_map[idx] + ">"] = (
-                        "<" + queries[idx][0]["uid"] + ">"
-                    )
-        finally:
-            txn.discard()
+        for i in range(abortTries):
+            txn = client.txn()
+            try:
+                mutation = txn.create_mutation(set_nquads=nquads)
+                request = txn.create_request(query=query, mutations=[mutation])
+                res = txn.do_request(request)
+                txn.commit()
+            except pydgraph.errors.AbortedError:
+                print("AbortedError %s" % i)
+                # another source allocated one of the xids: retry, the query then finds its uid
+                if i == abortTries - 1:
+                    raise
+                time.sleep(random.uniform(0, abortBackoff * 2**i))
+                continue
+            finally:
+                txn.discard()
+            break
+        #  new uid for xid are in res.uids
+        #  existing uid for xid are res.json payload
+        for n in res.uids:
+            idx = n[n.index("(") + 1 : n.index(")")]
+            xidmap["<" + blank_map[idx] + ">"] = "<" + res.uids[n] + ">"
+
+        queries = json.loads(res.json)
+        for idx in queries:
+            if len(queries[idx]) > 0:
+                xidmap["<" + blank_map[idx] + ">"] = (
+                    "<" + queries[idx][0]["uid"] + ">"
+                )
 
 
 def substituteXid(match_obj, xidmap):
@@ -102,8 +129,7 @@ def mutate_rdf(client, nquads):
         print("mutate rdf \n")
         body = "\n".join(nquads)
 
-        tries = 3
-        for i in range(tries):
+        for i in range(abortTries):
             txn = client.txn()
             try:
                 res = txn.mutate(set_nquads=body)
@@ -112,12 +138,12 @@ def mutate_rdf(client, nquads):
                 ret["total_ns"] = res.latency.total_ns
             except pydgraph.errors.AbortedError:
                 print("AbortedError %s" % i)
+                # concurrent loads may write the same nodes, retry after a random wait
+                if i == abortTries - 1:
+                    # the RDF would be lost: fail the load
+                    raise
+                time.sleep(random.uniform(0, abortBackoff * 2**i))
                 continue
-            except Exception as inst:
-                print(type(inst))  # the exception type
-                print(inst.args)  # arguments stored in .args
-                print(inst)
-                break
             finally:
                 txn.discard()
             break
@@ -126,9 +152,15 @@ def mutate_rdf(client, nquads):
 
 
 def split_mutate(client, body, xidmap):
-    b2 = re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, xidmap), body)
-    allocate_uid(client, b2, xidmap)
-    body = re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, xidmap), b2)
+    lock = xidmap.lock if isinstance(xidmap, SharedXidMap) else nullcontext()
+    with lock:
+        b2 = re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, xidmap), body)
+    # the round-trip to Dgraph runs outside the lock, concurrent sources allocate in parallel
+    allocated = {}
+    allocate_uid(client, b2, allocated)
+    with lock:
+        xidmap.update(allocated)
+        body = re_blank_bracket.sub(lambda match_obj: substituteXid(match_obj, xidmap), b2)
     # no more blank node at this point
     # cpu_count = mp.cpu_count()
     nquads = body.split("\n")
@@ -168,10 +200,7 @@ def upload_schema(client, schema):
 
 
 def upload_xid_schema(client, xid_predicate):
-    schema = f"""
-    {xid_predicate}: string @index(exact) @upsert .
-    """
-    upload_schema(client, schema)
+    upload_schema(client, xid_schema(xid_predicate))
     print("xid definition uploaded.")
 
 
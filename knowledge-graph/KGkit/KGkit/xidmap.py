@@ -0,0 +1,256 @@
+import sqlite3
+import zlib
+from collections import OrderedDict
+
+import numpy as np
+
+
+def xid_schema(predicate="xid"):
+    # schema of the xid predicate, the same for KGkit and the CSV importers:
+    # exact index for the eq() lookups of the upserts, @upsert so concurrent loads conflict on a new xid
+    return f"<{predicate}>: string @index(exact) @upsert ."
+
+
+class SqliteXidMap:
+    # xid -> uid map persisted in a SQLite file, used in place of the xidmap dict.
+    # Keys and values have the RDF form used by substituteXid: "<_:Foo_1>" -> "<0x1a>"
+    # they are stored as xid TEXT -> uid INTEGER.
+    # Lookups go through an LRU cache (misses included), writes are committed every commit_every
+    # entries and on close: an xid lost in a crash is found again by the upsert of allocate_uid.
+    def __init__(self, path, cache_size=1000000, commit_every=10000):
+        self.path = path
+        self.db = sqlite3.connect(path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS xidmap (xid TEXT PRIMARY KEY, uid INTEGER NOT NULL) WITHOUT ROWID"
+        )
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT) WITHOUT ROWID"
+        )
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.commit_every = commit_every
+        self.pending = 0
+        self.count = self.db.execute("SELECT COUNT(*) FROM xidmap").fetchone()[0]
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def set_meta(self, key, value):
+        self.db.execute("INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)", (key, value))
+        self.db.commit()
+
+    def cache_put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+
+    def lookup(self, key):
+        # return the uid of "<xid>" as "<0x..>" or None
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        row = self.db.execute("SELECT uid FROM xidmap WHERE xid = ?", (key[1:-1],)).fetchone()
+        value = "<" + hex(row[0]) + ">" if row is not None else None
+        self.cache_put(key, value)
+        return value
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def __getitem__(self, key):
+        value = self.lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.lookup(key)
+        return value if value is not None else default
+
+    def __setitem__(self, key, value):
+        self.update({key: value})
+
+    def update(self, mapping):
+        rows = [(key[1:-1], int(value[1:-1], 16)) for key, value in mapping.items()]
+        # insert the new xids and count them, then update the existing ones if any
+        before = self.db.total_changes
+        self.db.executemany("INSERT OR IGNORE INTO xidmap (xid, uid) VALUES (?, ?)", rows)
+        inserted = self.db.total_changes - before
+        if inserted < len(rows):
+            self.db.executemany("UPDATE xidmap SET uid = ? WHERE xid = ?", [(uid, xid) for xid, uid in rows])
+        self.count += inserted
+        for key, value in mapping.items():
+            if key in self.cache or len(self.cache) < self.cache_size:
+                self.cache_put(key, value)
+        self.pending += len(rows)
+        if self.pending >= self.commit_every:
+            self.commit()
+
+    def __len__(self):
+        return self.count
+
+    def max_uid(self):
+        # largest uid of the map, 0 when empty
+        self.commit()
+        return self.db.execute("SELECT MAX(uid) FROM xidmap").fetchone()[0] or 0
+
+    def items(self):
+        # iterate over the ("<xid>", "<0x..>") entries
+        self.commit()
+        for xid, uid in self.db.execute("SELECT xid, uid FROM xidmap"):
+            yield "<" + xid + ">", "<" + hex(uid) + ">"
+
+    def clear(self):
+        self.db.execute("DELETE FROM xidmap")
+        self.db.commit()
+        self.cache.clear()
+        self.pending = 0
+        self.count = 0
+
+    def commit(self):
+        self.db.commit()
+        self.pending = 0
+
+    def close(self):
+        self.commit()
+        self.db.close()
+
+
+class CompactXidMap:
+    # in-memory xid -> uid map, used in place of the xidmap dict for large imports.
+    # Keys and values have the RDF form used by substituteXid: "<_:Foo_1>" -> "<0x1a>"
+    # an xid is kept as a 64-bit hash and a 32-bit check (crc32), its uid as a uint64:
+    # 20 bytes per xid in sorted NumPy runs instead of ~150 bytes for the strings in a dict.
+    # New entries are buffered in a dict and written as a run every buffer_size entries,
+    # runs are merged when they reach the size of the previous run.
+    # An xid whose hash is used by another xid (different check) is kept with its string
+    # in the collisions dict, so a lookup never returns the uid of another xid
+    # unless both the hash and the check collide (96 bits).
+    # xids are not kept: the map cannot be iterated.
+    def __init__(self, buffer_size=100000):
+        self.buffer_size = buffer_size
+        self.recent = {}  # xid -> uid strings not written in a run yet
+        self.collisions = {}  # xid -> uid strings of xids whose hash collides
+        self.runs = []  # (sorted hashes, checks, uids), oldest first
+        self.count = 0  # number of xids in runs and collisions
+
+    @staticmethod
+    def fingerprint(key):
+        return hash(key), zlib.crc32(key.encode())
+
+    def lookup(self, key):
+        # return the uid of "<xid>" as "<0x..>" or None
+        value = self.recent.get(key)
+        if value is not None:
+            return value
+        value = self.collisions.get(key)
+        if value is not None:
+            return value
+        if len(self.runs) == 0:
+            return None
+        fp, check = self.fingerprint(key)
+        for hashes, checks, uids in reversed(self.runs):
+            idx = int(hashes.searchsorted(fp))
+            if idx < len(hashes) and hashes.item(idx) == fp:
+                if checks.item(idx) != check:
+                    return None
+                return "<" + hex(uids.item(idx)) + ">"
+        return None
+
+    def lookup_runs(self, hashes):
+        # return (found, checks) of sorted hashes in the runs, newest runs first
+        found = np.zeros(len(hashes), dtype=bool)
+        checks = np.zeros(len(hashes), dtype=np.uint32)
+        for run_hashes, run_checks, _ in reversed(self.runs):
+            todo = np.flatnonzero(~found)
+            if len(todo) == 0:
+                break
+            idx = np.searchsorted(run_hashes, hashes[todo])
+            idx[idx == len(run_hashes)] = 0
+            hit = run_hashes[idx] == hashes[todo]
+            found[todo[hit]] = True
+            checks[todo[hit]] = run_checks[idx[hit]]
+        return found, checks
+
+    def __contains__(self, key):
+        return self.lookup(key) is not None
+
+    def __getitem__(self, key):
+        value = self.lookup(key)
+        if value is None:
+            raise KeyError(key)
+        return value
+
+    def get(self, key, default=None):
+        value = self.lookup(key)
+        return value if value is not None else default
+
+    def __setitem__(self, key, value):
+        self.recent[key] = value
+        if len(self.recent) >= self.buffer_size:
+            self.flush()
+
+    def update(self, mapping):
+        self.recent.update(mapping)
+        if len(self.recent) >= self.buffer_size:
+            self.flush()
+
+    def flush(self):
+        # write the buffered entries in a new run
+        entries = []
+        for key, value in self.recent.items():
+            if key in self.collisions:
+                self.collisions[key] = value
+            else:
+                entries.append((key, value))
+        self.recent = {}
+        if len(entries) == 0:
+            return
+        fingerprints = [self.fingerprint(key) for key, _ in entries]
+        hashes = np.array([fp for fp, _ in fingerprints], dtype=np.int64)
+        checks = np.array([check for _, check in fingerprints], dtype=np.uint32)
+        uids = np.array([int(value[1:-1], 16) for _, value in entries], dtype=np.uint64)
+        order = np.argsort(hashes, kind="stable")
+        hashes = hashes[order]
+        checks = checks[order]
+        uids = uids[order]
+        # a hash already used by another xid in this batch or in a run is a collision
+        collide = np.append(False, hashes[1:] == hashes[:-1])
+        found, stored = self.lookup_runs(hashes)
+        collide |= found & (stored != checks)
+        for i in np.flatnonzero(collide):
+            key, value = entries[order[i]]
+            self.collisions[key] = value
+        # xids already in a run are updated, the others are new
+        self.count += int(np.count_nonzero(~found | (stored != checks)))
+        keep = ~collide
+        if keep.any():
+            self.add_run(hashes[keep], checks[keep], uids[keep])
+
+    def add_run(self, hashes, checks, uids):
+        self.runs.append((hashes, checks, uids))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2 * len(self.runs[-1][0]):
+            newer = self.runs.pop()
+            older = self.runs.pop()
+            hashes = np.concatenate([older[0], newer[0]])
+            checks = np.concatenate([older[1], newer[1]])
+            uids = np.concatenate([older[2], newer[2]])
+            order = np.argsort(hashes, kind="stable")
+            hashes = hashes[order]
+            # keep the newer uid of each xid
+            last = np.append(hashes[1:] != hashes[:-1], True)
+            self.runs.append((hashes[last], checks[order][last], uids[order][last]))
+
+    def __len__(self):
+        self.flush()
+        return self.count
+
+    def clear(self):
+        self.recent = {}
+        self.collisions = {}
+        self.runs = []
+        self.count = 0
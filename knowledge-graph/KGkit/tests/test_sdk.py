@@ -1,7 +1,117 @@
+import json
+import re
+import threading
 import unittest
+from types import SimpleNamespace
 import pandas as pd
-from KGkit import KG
-from KGkit.sdk import guess_properties, guess_relationships
+import pydgraph
+from KGkit import KG, DataSource
+from KGkit.sdk import generateSchema, guess_id_field, guess_properties, guess_relationships, profile_columns
+from KGkit.ontology import AddKGClassInput, Entity, UpsertBlock, add_kg_class, build_entity, iter_entities, iter_kg_classes, iter_kg_schemas
+from KGkit.types import TableEntityMapping
+
+class FakeDgraph:
+    # in-memory stand-in of a Dgraph client for the xid upserts and the mutations of the loaders.
+    # The first try of every upsert is aborted, as if a concurrent source had allocated one of its xids
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.xids = {}
+        self.triples = []
+        self.tried = set()
+
+    def alter(self, operation):
+        pass
+
+    def txn(self, read_only=False):
+        return FakeTxn(self)
+
+class FakeTxn:
+    def __init__(self, server):
+        self.server = server
+
+    def create_mutation(self, set_nquads):
+        return set_nquads
+
+    def create_request(self, query, mutations):
+        return query, mutations
+
+    def do_request(self, request):
+        query, _ = request
+        server = self.server
+        with server.lock:
+            if query not in server.tried:
+                server.tried.add(query)
+                raise pydgraph.errors.AbortedError()
+            found, uids = {}, {}
+            for var, xid in re.findall(r'(u_\d+) as u_\d+\(func: eq\(xid, "([^"]+)"\)\)', query):
+                if xid in server.xids:
+                    found[var] = [{'uid': server.xids[xid]}]
+                else:
+                    server.xids[xid] = hex(len(server.xids) + 1)
+                    uids['uid(%s)' % var] = server.xids[xid]
+                    found[var] = []
+        return SimpleNamespace(uids=uids, json=json.dumps(found))
+
+    def mutate(self, set_nquads):
+        with self.server.lock:
+            self.server.triples.extend(line for line in set_nquads.split('\n') if line.strip())
+        return SimpleNamespace(latency=SimpleNamespace(total_ns=0))
+
+    def commit(self):
+        pass
+
+    def discard(self):
+        pass
+
+class FakePagedDgraph:
+    # read-only stand-in of a Dgraph client serving the list block of the paginated queries
+    # from nodes 0x1..0x<count>, first/after applied on the uids
+    def __init__(self, count):
+        self.count = count
+        self.queries = []
+
+    def txn(self, read_only=False):
+        return self
+
+    def query(self, statement):
+        self.queries.append(statement)
+        first = int(re.search(r'first: (\d+)', statement).group(1))
+        after = re.search(r'after: (0x[0-9a-f]+)', statement)
+        start = int(after.group(1), 16) + 1 if after else 1
+        uids = range(start, min(start + first, self.count + 1))
+        if 'KGSchema' in statement:
+            nodes = [{'uid': hex(i), 'label': 's%d' % i, 'classes': []} for i in uids]
+        elif 'KGClass.role' in statement:
+            nodes = [{'uid': hex(i), 'id': 'c%d' % i, 'label': 'c%d' % i} for i in uids]
+        else:
+            nodes = [{'uid': hex(i), 'id': 'e%d' % i, 'label': 'e%d' % i, 'is_a': 'C'} for i in uids]
+        return SimpleNamespace(json=json.dumps({'list': nodes}))
+
+    def discard(self):
+        pass
+
+class FakeUpsertDgraph:
+    # records the upsert requests, the first one is aborted
+    def __init__(self):
+        self.requests = []
+
+    def txn(self, read_only=False):
+        return self
+
+    def create_mutation(self, set_nquads):
+        return set_nquads
+
+    def create_request(self, query, mutations, commit_now=None):
+        return query, mutations, commit_now
+
+    def do_request(self, request):
+        self.requests.append(request)
+        if len(self.requests) == 1:
+            raise pydgraph.errors.AbortedError()
+        return SimpleNamespace(uids={'uid(c0)': '0x1'}, json='{}')
+
+    def discard(self):
+        pass
 
 class TestKGkitFunction(unittest.TestCase):
     def test_constructor(self):
@@ -12,7 +122,7 @@ class TestKGkitFunction(unittest.TestCase):
         self.assertIsNone(kg.drop_data_and_schema())
         gql = kg.GraphQL_schema()
         self.assertIsNone(gql)
-        self.assertEqual(kg.schema(),'<xid>:  string @index(hash) .\n')
+        self.assertEqual(kg.schema(),'<xid>:  string @index(exact) @upsert .\n')
 
         data = {
         'Project:ID': ['x', 'y'],
@@ -25,5 +135,125 @@ class TestKGkitFunction(unittest.TestCase):
         self.assertEqual(guess_properties('Project',['Project:ID', 'Project.Name', 'Test'],False), ['Project:ID', 'Project.Name'])
         self.assertEqual(guess_relationships('Project',['Project:ID', 'Project.Name', 'School.ID']), ['School.ID'])
 
+    def test_load_tabular_data_parallel(self):
+        kg = KG()
+        kg.drop_data_and_schema()
+        schools = pd.DataFrame({'School.ID': ['s1', 's2'], 'School.Name': ['n1', 'n2']})
+        projects = pd.DataFrame({'Project.ID': ['p1', 'p2', 'p3'], 'School.ID': ['s1', 's2', 's1']})
+        res = kg.load_tabular_data([DataSource("Projects", projects), DataSource("Schools", schools)], parallel=2)
+        self.assertEqual([m.error for m in res], [None, None])
+        txn = kg.dgraph_client.txn(read_only=True)
+        try:
+            data = json.loads(txn.query('{ s(func: type(School)) { count(uid) } }').json)
+        finally:
+            txn.discard()
+        # the schools referenced by the projects and loaded from Schools are the same nodes
+        self.assertEqual(data['s'][0]['count'], 2)
+
+    def test_load_tabular_data_parallel_mocked(self):
+        kg = KG.__new__(KG)
+        kg.dgraph_client = FakeDgraph()
+        schools = pd.DataFrame({'School.ID': ['s%d' % i for i in range(50)], 'School.Name': ['n%d' % i for i in range(50)]})
+        projects = pd.DataFrame({'Project.ID': ['p%d' % i for i in range(200)], 'School.ID': ['s%d' % (i % 50) for i in range(200)]})
+        res = kg.load_tabular_data([DataSource("Projects", projects), DataSource("Schools", schools)], parallel=2)
+        self.assertEqual([m.error for m in res], [None, None])
+        triples = kg.dgraph_client.triples
+        self.assertFalse(any('_:' in t.split(' ')[0] for t in triples))
+        # the schools referenced by the projects and loaded from Schools are the same nodes
+        schools = {t.split(' ')[0] for t in triples if t.endswith('<dgraph.type> "School" .')}
+        self.assertEqual(len(schools), 50)
+        targets = {t.split(' ')[2] for t in triples if ' <Project.School> ' in t}
+        self.assertEqual(targets, schools)
+
+    def test_load_numeric_and_datetime_frames(self):
+        kg = KG.__new__(KG)
+        kg.dgraph_client = FakeDgraph()
+        items = pd.DataFrame({'Item.ID': [1, 2, 3], 'Item.Qty': [10, 20, 30], 'Item.Price': [1.5, 2.5, 3.0]})
+        events = pd.DataFrame({'Event.ID': ['e1', 'e2'], 'Event.Date': pd.to_datetime(['2020-01-01', '2020-01-02'])})
+        res = kg.load_tabular_data([DataSource("Items", items), DataSource("Events", events)])
+        self.assertEqual([m.error for m in res], [None, None])
+        self.assertIn('<Item.Qty>: int @index(int) .', res[0].schema)
+        self.assertIn('<Event.Date>: datetime @index(day) .', res[1].schema)
+        objects = {t.split(' ', 2)[1]: set() for t in kg.dgraph_client.triples}
+        for t in kg.dgraph_client.triples:
+            objects[t.split(' ', 2)[1]].add(t.split(' ', 2)[2])
+        # the int columns of a numeric frame are not written as floats, dates are converted
+        self.assertEqual(objects['<Item.Qty>'], {'"10" .', '"20" .', '"30" .'})
+        self.assertEqual(objects['<Item.Price>'], {'"1.5" .', '"2.5" .', '"3.0" .'})
+        self.assertIn('"_:Item_1" .', objects['<xid>'])
+        self.assertEqual(objects['<Event.Date>'], {'"2020-01-01T00:00:00" .', '"2020-01-02T00:00:00" .'})
+
+    def test_add_kg_class(self):
+        client = FakeUpsertDgraph()
+        uids = add_kg_class(client, 'ns', [AddKGClassInput('Person', 'MAIN', 'a person'), AddKGClassInput('Org', 'MAIN', '')])
+        self.assertEqual(uids, {'uid(c0)': '0x1'})
+        # aborted once then retried: the query is sent with the mutation and committed at once
+        self.assertEqual(len(client.requests), 2)
+        query, mutations, commit_now = client.requests[-1]
+        self.assertTrue(commit_now)
+        self.assertIn('s as var(func: eq(KGSchema.label, "ns"))', query)
+        self.assertIn('c1 as var(func: eq(KGClass.id, "ns/Org"))', query)
+        self.assertIn('uid(c0) <KGClass.isDefinedBy> uid(s) .', mutations[0])
+        self.assertIn('uid(s) <KGSchema.classes> uid(c1) .', mutations[0])
+
+    def test_paginated_queries(self):
+        client = FakePagedDgraph(7)
+        self.assertEqual([e.id for e in iter_entities(client, page_size=3)], ['e%d' % i for i in range(1, 8)])
+        # the cursor is the uid of the last node of the previous page, a short page ends the iteration
+        cursors = [re.search(r'first: 3(, after: \w+)?\)', q).group(1) for q in client.queries]
+        self.assertEqual(cursors, [None, ', after: 0x3', ', after: 0x6'])
+        # a full last page is followed by an empty one
+        client = FakePagedDgraph(6)
+        self.assertEqual(len(list(iter_kg_classes(client, page_size=3))), 6)
+        self.assertEqual(len(client.queries), 3)
+        for page_size in (1, 3, 10):
+            for iterate in (iter_entities, iter_kg_classes, lambda client, **kwargs: iter_kg_schemas(client, None, **kwargs)):
+                pages = list(iterate(FakePagedDgraph(7), page_size=page_size))
+                prefetched = list(iterate(FakePagedDgraph(7), page_size=page_size, prefetch=True))
+                self.assertEqual(prefetched, pages)
+                self.assertEqual(len(pages), 7)
+
+    def test_profile_columns(self):
+        n = 500
+        df = pd.DataFrame({
+            # unique in the first 100 rows only
+            'Project.Code': [str(i % 200) for i in range(n)],
+            'Project.ID': ['p%d' % i for i in range(n)],
+            'Project.Zip': ['%05d' % i for i in range(n)],
+            'Project.Cost': ['%.2f' % (i / 3) for i in range(n)],
+            'Project.Date': ['2020-01-%02d' % (1 + i % 28) for i in range(n)],
+            'LAT': [str(37 + i / 1000) for i in range(n)],
+            'LONG': [str(-121 - i / 1000) for i in range(n)],
+            'Project.Grade': ['Grades %d-%d' % (3 * (i % 4), 3 * (i % 4) + 2) for i in range(n)],
+            'Project.Title': ['Title of the project %d' % i if i % 2 else None for i in range(n)],
+        }, dtype=str)
+        profiles = profile_columns(df, 100)
+        self.assertEqual(guess_id_field(df, profiles), 'Project.ID')
+        self.assertEqual([profiles[c].dtype for c in df.columns], ['int', 'string', 'string', 'float', 'datetime', 'float', 'float', 'string', 'string'])
+        self.assertEqual(profiles['Project.Date'].datetime_format, '%Y-%m-%d')
+        self.assertEqual(profiles['Project.Code'].distinct, 200)
+        mapping = TableEntityMapping('Project', 'Project.ID', df.columns.to_list(), [], profiles)
+        schema = generateSchema('Project', mapping)
+        self.assertIn('<Project.Code>: int @index(int) .', schema)
+        self.assertIn('<Project.ID>: string @index(hash) .', schema)
+        self.assertIn('<Project.Cost>: float @index(float) .', schema)
+        self.assertIn('<Project.Date>: datetime @index(day) .', schema)
+        self.assertIn('<Project.Grade>: string @index(exact) .', schema)
+        self.assertIn('<Project.Title>: string @index(term) .', schema)
+        self.assertIn('<Project.location>: geo @index(geo) .', schema)
+        self.assertNotIn('<Project.LAT>', schema)
+        self.assertIn('<Project.Cost>: float .', generateSchema('Project', mapping, with_indexes=False))
+
+    def test_batched_entities_upsert(self):
+        block = UpsertBlock()
+        for label in ['Ada "Countess" Lovelace', 'Alan Turing', 'Alan Turing']:
+            build_entity(block, Entity(label=label, is_a='Person'), 'doc1')
+        # one var block per entity, class and document
+        self.assertEqual(len(block.query), 4)
+        self.assertIn('v0 as var(func: eq(xid, "Person#Ada \\"Countess\\" Lovelace"))', block.query)
+        self.assertIn('uid(v0) <is_a> uid(c1) .', block.nquads)
+        self.assertIn('uid(v3) <found_in> uid(d2) .', block.nquads)
+        self.assertIn('uid(v3) <rdfs:label> "Alan Turing" .', block.nquads)
+
 if __name__ == "__main__":
     unittest.main()
@@ -15,5 +15,5 @@ res = kg.load_tabular_data([
     DataSource("Projects",df1),
     DataSource("Schools",df2),
     DataSource("Donations",df3)
-],mutate=True)
+],mutate=True, parallel=3)
 # pprint(res)